@@ -0,0 +1,50 @@
+import numpy as np
+
+from modules.controller.constants import COLOR_INDEX_BITS
+
+
+class PageColorIndex:
+    """
+    Quantized BGR colors of the masked pixels of one page, for instant color range feedback.
+
+    A summed-area table of the 3-D color histogram gives the number of pixels in a color
+    range with eight lookups, and the quantized color of every pixel gives the pixels in
+    the range through a lookup table, without touching the image. A quantized color is in
+    the range if its bin overlaps it, so the result can include colors a few levels outside.
+    """
+    def __init__(self, image: np.ndarray, indices: np.ndarray, bits: int = COLOR_INDEX_BITS):
+        self.bits = bits
+        self.bins = 1 << bits
+        self.indices = indices
+        quantized = image.reshape(-1, 3)[indices] >> (8 - bits)
+        self.codes = ((quantized[:, 0].astype(np.uint32) << 2 * bits) |
+                      (quantized[:, 1].astype(np.uint32) << bits) | quantized[:, 2]).astype(np.uint16)
+        histogram = np.bincount(self.codes, minlength=self.bins ** 3).reshape((self.bins,) * 3)
+        self.table = np.zeros((self.bins + 1,) * 3, np.int32)
+        self.table[1:, 1:, 1:] = histogram.cumsum(axis=0).cumsum(axis=1).cumsum(axis=2)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def _bin_ranges(self, lower, upper):
+        """First and one past the last bin of every channel that overlaps [lower, upper]."""
+        shift = 8 - self.bits
+        first = np.asarray(lower, int) >> shift
+        last = (np.asarray(upper, int) >> shift) + 1
+        return first, np.maximum(last, first)
+
+    def count(self, lower, upper) -> int:
+        """Number of masked pixels in the BGR range."""
+        (b0, g0, r0), (b1, g1, r1) = self._bin_ranges(lower, upper)
+        t = self.table
+        return int(t[b1, g1, r1] - t[b0, g1, r1] - t[b1, g0, r1] - t[b1, g1, r0]
+                   + t[b0, g0, r1] + t[b0, g1, r0] + t[b1, g0, r0] - t[b0, g0, r0])
+
+    def in_range(self, lower, upper) -> np.ndarray:
+        """Boolean flag of every masked pixel (in the order of ``indices``), True if it is in the BGR range."""
+        first, last = self._bin_ranges(lower, upper)
+        axes = [np.zeros(self.bins, bool) for _ in range(3)]
+        for axis, start, stop in zip(axes, first, last):
+            axis[start:stop] = True
+        lut = axes[0][:, None, None] & axes[1][None, :, None] & axes[2][None, None, :]
+        return lut.reshape(-1)[self.codes]
@@ -1,5 +1,7 @@
 # base_controller.py
-from modules.controller.constants import MaskMode
+import os
+
+from modules.controller.constants import MaskMode, COLOR_RANGE_PARAMETERS
 from modules.controller.file_handler import FileHandler
 from modules.controller.gui_config import MaskSelectorGUIConfig, BaseGUIConfig, ThresholdGUIConfig
 from modules.controller.gui_config import ParameterAdjusterGUIConfig
@@ -9,7 +11,8 @@ from modules.model.base_model import BaseModel
 
 from modules.controller.mask_manipulator import MaskManipulator
 from modules.controller.event_handlers import MouseHandler, KeyboardHandler
-from modules.utils import remove_watermark
+from modules.page_cache import ProcessedPageCache, RasterCache
+from modules.utils import RemovalOptions, remove_watermark, show_progress_window
 from modules.view.tkinter_view import TkinterView
 from modules.view.pyqt_view import PyQt5View
 
@@ -17,7 +20,14 @@ from modules.view.pyqt_view import PyQt5View
 class BaseController:
     def __init__(self, args):
         self.view: DisplayInterface = PyQt5View(self) if args.gui_type == 'pyqt5' else TkinterView(self)
-        self.model = BaseModel(args.pdf_path, args.dpi, args.max_width, args.max_height)
+        raster_cache = RasterCache(os.path.join(args.cache_dir, 'rasters')) if args.cache_dir else None
+        self.model = BaseModel(args.pdf_path, args.dpi, args.max_width, args.max_height,
+                               args.median_cache_mb * 1024 * 1024, raster_cache, args.workers)
+        self.model.config_model.set_removal_options(RemovalOptions(args.sharpen_mask_only, args.fill_from_vicinity))
+        self.workers = args.workers
+        self.page_cache = ProcessedPageCache(os.path.join(args.cache_dir, 'pages')) if args.cache_dir else None
+        # True while a color range slider is dragged with the mouse
+        self.dragging_range = False
 
         # Initialize components
         self.file_handler: FileHandlerInterface = FileHandler(self.model)
@@ -136,6 +146,17 @@ class BaseController:
 
     def update_parameter(self, attr, val):
         self.model.parameter_model.set_current_parameter(attr, int(val))
+        if attr in COLOR_RANGE_PARAMETERS and self.dragging_range:
+            # The removal runs when the slider is released, until then only the pixels in range are shown
+            self.view.display_image(self.model.get_range_preview_image())
+        else:
+            self.view.display_image(self.model.get_processed_current_image())
+
+    def on_parameter_pressed(self):
+        self.dragging_range = True
+
+    def on_parameter_released(self):
+        self.dragging_range = False
         self.view.display_image(self.model.get_processed_current_image())
 
     def get_parameters(self):
@@ -167,6 +188,11 @@ class BaseController:
     def get_threshold_max(self):
         return self.model.config_model.get_threshold_max()
 
+    def auto_mask(self):
+        self.mask_manipulator.save_state()
+        self.mask_manipulator.auto_mask()
+        self.update_view()
+
     def reset_mask(self):
         self.mask_manipulator.reset_mask()
         self.model.image_model.update_current_image()
@@ -186,6 +212,23 @@ class BaseController:
         self.file_handler.load_images()
         self.change_mode(MaskMode.SELECT)
 
+    def save_parameters(self):
+        self.file_handler.save_parameters()
+
+    def load_parameters(self):
+        self.file_handler.load_parameters()
+        self.view.update_trackbars(self.model.parameter_model.get_current_parameters_data_as_dict())
+        self.update_view()
+
+    def auto_tune_parameters(self):
+        self.model.auto_tune_parameters()
+        self.view.update_trackbars(self.model.parameter_model.get_current_parameters_data_as_dict())
+        self.update_view()
+
+    def estimate_watermark_blend(self):
+        self.model.estimate_watermark_blend()
+        self.update_view()
+
     def redo(self):
         self.mask_manipulator.redo()
         self.update_view()
@@ -195,10 +238,17 @@ class BaseController:
         self.update_view()
 
     def remove_watermark(self):
+        changed = []
         processed_images = remove_watermark(self.model.image_model.get_original_sized_images(),
                                             self.model.get_bgr_mask(),
-                                            self.model.parameter_model.get_parameters())
+                                            self.model.parameter_model.get_parameters(),
+                                            show_progress_window,
+                                            self.workers,
+                                            self.model.config_model.get_removal_options(),
+                                            self.page_cache,
+                                            changed)
         self.model.update_data(processed_images)
+        self.model.image_model.mark_changed_pages(changed)
 
 
     def exit(self):
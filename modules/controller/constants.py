@@ -1,6 +1,45 @@
-from enum import Enum, auto
+from enum import Enum, IntEnum, auto
 
-MAX_MEDIAN_IMAGE_NUMBER = 50
+# At most 255, the median accumulator counts the pages in uint8
+MAX_MEDIAN_IMAGE_NUMBER = 250
+# Memory budget of the median image cache
+MEDIAN_CACHE_BYTES = 256 * 1024 * 1024
+# Memory budget of the preview pages, the pages are rendered again when they were evicted
+PREVIEW_CACHE_BYTES = 512 * 1024 * 1024
+# Number of pages before and after the current one that are rendered in the background
+PREFETCH_PAGES = 2
+# Changing the removal algorithm has to invalidate the processed pages cached on disk
+PAGE_CACHE_VERSION = 2
+# Margin around the regions of the mask, it has to cover the inpainting radius and the sharpening kernel
+REGION_PADDING = 8
+# Only every n-th pixel (in both directions) is sampled for the most frequent color of a page
+FILL_COLOR_SAMPLE_STEP = 4
+# Size of the tiles (in pixels) used to estimate the local background
+BACKGROUND_TILE_SIZE = 16
+# Highest watermark opacity that is un-blended, the content under more opaque pixels is mostly noise
+MAX_BLEND_ALPHA = 0.9
+# Minimum variance of the background over the pages to estimate the blending of a pixel on its own
+MIN_BLEND_VARIANCE = 16.0
+MIN_BLEND_CORRELATION = 0.8
+# Opacity of the strongest watermark pixel when the pages do not tell it (same background on every page)
+ASSUMED_BLEND_ALPHA = 0.5
+# Pages used for the blend estimate of the preview, it runs on the GUI thread at about 0.2 s per page
+PREVIEW_BLEND_PAGES = 24
+# Automatic mask proposal: a pixel belongs to the watermark if it differs from the local background
+# by at least AUTO_MASK_MIN_CONTRAST gray levels, in the same direction, on AUTO_MASK_MIN_FRACTION of the pages
+AUTO_MASK_MIN_CONTRAST = 8
+AUTO_MASK_MIN_FRACTION = 0.8
+# Smaller connected regions of the proposed mask (in pixels) are dropped
+AUTO_MASK_MIN_AREA = 16
+# Resolution of the pages used for the proposal in headless mode
+AUTO_MASK_DPI = 100
+# Automatic color ranges: colors whose excess in the mask is below this fraction of the strongest one are left out
+AUTO_TUNE_MIN_EXCESS = 0.02
+# Bits per channel of the quantized colors used for the instant color range preview
+COLOR_INDEX_BITS = 5
+# Color of the pixels in the color range on the preview
+RANGE_HIGHLIGHT_COLOR = (255, 0, 255)
+COLOR_RANGE_PARAMETERS = ('r_min', 'r_max', 'g_min', 'g_max', 'b_min', 'b_max')
 
 class MaskMode(Enum):
     SELECT = auto()
@@ -9,6 +48,13 @@ class MaskMode(Enum):
     ADJUST = auto()
 
 
+class RemovalMode(IntEnum):
+    INPAINT = 0
+    MOST_COMMON_COLOR = 1
+    LOCAL_BACKGROUND = 2
+    ALPHA_UNBLEND = 3
+
+
 class CursorType(Enum):
     CIRCLE = 0
     SQUARE = 1
@@ -2,7 +2,8 @@ from tkinter import filedialog
 
 from modules.interfaces.interfaces import FileHandlerInterface
 from modules.model.base_model import BaseModel
-from modules.utils import load_pdf, save_images
+from modules.pages import PdfPages
+from modules.utils import save_images, save_images_in_place
 import os
 
 
@@ -17,7 +18,9 @@ class FileHandler(FileHandlerInterface):
             filetypes=[("All files", "*.*")]
         )
         if path:
-            images = load_pdf(path, self.model.image_model.image_data.dpi)
+            # The pages are rendered when they are shown or exported
+            image_data = self.model.image_model.image_data
+            images = PdfPages(path, image_data.dpi, image_data.raster_cache, image_data.workers)
             self.model.update_data(images)
 
     def save_images(self):
@@ -30,7 +33,14 @@ class FileHandler(FileHandlerInterface):
             ).name
             if not os.path.exists(output_path):
                 os.makedirs(output_path)
-            save_images(self.model.image_model.get_original_sized_images(), output_path)
+            images = self.model.image_model.get_original_sized_images()
+            pdf_pages = self.model.image_model.get_pdf_pages()
+            if pdf_pages is not None and pdf_pages.scanned and len(pdf_pages) == len(images):
+                # The images of a scan are replaced in a copy of the document
+                save_images_in_place(images, pdf_pages.pdf_path, output_path,
+                                     changed=self.model.image_model.get_changed_pages())
+            else:
+                save_images(images, output_path)
             return True
         except Exception as e:
             print(f"Error saving images: {str(e)}")
@@ -60,3 +70,27 @@ class FileHandler(FileHandlerInterface):
             self.model.mask_model.save_mask(path)
         except Exception as e:
             print(f"Error saving mask: {str(e)}")
+
+    def load_parameters(self, path=None):
+        """Load per-page removal parameters from file"""
+        try:
+            path = filedialog.askopenfilename(
+                title="Load parameters",
+                filetypes=[("JSON files", "*.json"), ("All files", "*.*")]
+            )
+            if path:
+                self.model.parameter_model.load_parameters(path)
+        except Exception as e:
+            print(f"Error loading parameters: {str(e)}")
+
+    def save_parameters(self):
+        try:
+            path = filedialog.asksaveasfile(
+                title="Save parameters",
+                defaultextension=".json",
+                filetypes=[("JSON files", "*.json"), ("All files", "*.*")],
+                initialfile="parameters.json"
+            ).name
+            self.model.parameter_model.save_parameters(path)
+        except Exception as e:
+            print(f"Error saving parameters: {str(e)}")
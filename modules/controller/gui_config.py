@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-from modules.controller.constants import MAX_MEDIAN_IMAGE_NUMBER
+from modules.controller.constants import MAX_MEDIAN_IMAGE_NUMBER, RemovalMode
 
 
 @dataclass
@@ -11,8 +11,10 @@ class TrackbarTexts:
     g_min = 'Green min:'
     b_max = 'Blue max:'
     b_min = 'Blue min:'
-    mode = 'Mode: Inpaint or most common color'
+    mode = 'Mode: Inpaint, most common color, local background or alpha unblend'
     w = 'Sharpening factor (w)'
+    inpaint_method = 'Inpainting method: Telea or Navier-Stokes'
+    levels = 'Inpainting pyramid levels'
 
 
 class BaseGUIConfig:
@@ -59,8 +61,13 @@ class BaseGUIConfig:
                 'text': 'Reset mask (R)',
                 'callback': controller.reset_mask,
                 'position': (3, 0),
-                'margin': (0, 0, 25, 0),
-                'columnspan': 2
+                'margin': (0, 0, 25, 0)
+            },
+            'Auto mask': {
+                'text': 'Auto mask',
+                'callback': controller.auto_mask,
+                'position': (3, 1),
+                'margin': (0, 0, 25, 0)
             },
             'Next': {
                 'text': '>',
@@ -258,10 +265,36 @@ class ParameterAdjusterGUIConfig(BaseGUIConfig):
                     'columnspan': 2,
                     'bg_color': (70,125, 75),
                 },
+                'Load params': {
+                    'text': 'Load params',
+                    'callback': controller.load_parameters,
+                    'position': (2, 0),
+                    'margin': (5, 0, 0, 0)
+                },
+                'Save params': {
+                    'text': 'Save params',
+                    'callback': controller.save_parameters,
+                    'position': (2, 1),
+                    'margin': (5, 0, 0, 0)
+                },
+                'Auto tune': {
+                    'text': 'Auto tune color ranges',
+                    'callback': controller.auto_tune_parameters,
+                    'position': (3, 0),
+                    'margin': (5, 0, 0, 0),
+                    'columnspan': 2
+                },
+                'Estimate blend': {
+                    'text': 'Estimate blend',
+                    'callback': controller.estimate_watermark_blend,
+                    'position': (4, 0),
+                    'margin': (5, 0, 0, 0),
+                    'columnspan': 2
+                },
                 'Back': {
                     'text': 'Back',
                     'callback':controller.on_click_back,
-                    'position': (2, 0),
+                    'position': (5, 0),
                     'margin': (5, 0, 0, 0),
                     'columnspan': 2,
                     'bg_color': (150, 75, 75)
@@ -271,29 +304,49 @@ class ParameterAdjusterGUIConfig(BaseGUIConfig):
             'trackbars': {
                 'mode' : {'value': controller.model.parameter_model.get_current_parameters().mode,
                          'callback': lambda val, attr='mode': controller.on_parameter_changed(attr, val),
-                         'range': (0, 1)
+                         'range': (0, len(RemovalMode) - 1)
                                       },
+                'inpaint_method': {'value': controller.model.parameter_model.get_current_parameters().inpaint_method,
+                                   'callback': lambda val, attr='inpaint_method': controller.on_parameter_changed(attr, val),
+                                   'range': (0, 1)
+                                   },
+                'levels': {'value': controller.model.parameter_model.get_current_parameters().levels,
+                           'callback': lambda val, attr='levels': controller.on_parameter_changed(attr, val),
+                           'range': (0, 3)
+                           },
                 'w': {'value': controller.model.parameter_model.get_current_parameters().w,
                       'callback': lambda val, attr='w': controller.on_parameter_changed(attr, val),
                       'range': (0, 25)
                                    },
                 'r_min': {'value': controller.model.parameter_model.get_current_parameters().r_min,
-                          'callback': lambda val, attr='r_min': controller.on_parameter_changed(attr, val)
+                          'callback': lambda val, attr='r_min': controller.on_parameter_changed(attr, val),
+                          'press_callback': controller.on_parameter_pressed,
+                          'release_callback': controller.on_parameter_released
                                        },
                 'r_max': {'value': controller.model.parameter_model.get_current_parameters().r_max,
-                          'callback': lambda val, attr='r_max': controller.on_parameter_changed(attr, val)
+                          'callback': lambda val, attr='r_max': controller.on_parameter_changed(attr, val),
+                          'press_callback': controller.on_parameter_pressed,
+                          'release_callback': controller.on_parameter_released
                                       },
                 'g_min': {'value': controller.model.parameter_model.get_current_parameters().g_min,
-                          'callback': lambda val, attr='g_min': controller.on_parameter_changed(attr, val)
+                          'callback': lambda val, attr='g_min': controller.on_parameter_changed(attr, val),
+                          'press_callback': controller.on_parameter_pressed,
+                          'release_callback': controller.on_parameter_released
                                       },
                 'g_max': {'value': controller.model.parameter_model.get_current_parameters().g_max,
-                          'callback': lambda val, attr='g_max': controller.on_parameter_changed(attr, val)
+                          'callback': lambda val, attr='g_max': controller.on_parameter_changed(attr, val),
+                          'press_callback': controller.on_parameter_pressed,
+                          'release_callback': controller.on_parameter_released
                                       },
                 'b_min': {'value': controller.model.parameter_model.get_current_parameters().b_min,
-                          'callback': lambda val, attr='b_min': controller.on_parameter_changed(attr, val)
+                          'callback': lambda val, attr='b_min': controller.on_parameter_changed(attr, val),
+                          'press_callback': controller.on_parameter_pressed,
+                          'release_callback': controller.on_parameter_released
                                       },
                 'b_max': {'value': controller.model.parameter_model.get_current_parameters().b_max,
-                          'callback': lambda val, attr='b_max': controller.on_parameter_changed(attr, val)
+                          'callback': lambda val, attr='b_max': controller.on_parameter_changed(attr, val),
+                          'press_callback': controller.on_parameter_pressed,
+                          'release_callback': controller.on_parameter_released
                                       }
             },
             'checkboxes': {
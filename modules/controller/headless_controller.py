@@ -0,0 +1,81 @@
+# headless_controller.py
+import itertools
+import os
+
+import numpy as np
+
+from modules.controller.constants import AUTO_MASK_DPI
+from modules.model.parameter_model import ParamsForRemoval, load_parameters, set_color_ranges
+from modules.page_cache import ProcessedPageCache, RasterCache
+from modules.utils import RemovalOptions, get_page_count, iter_pdf_pages, iter_removed_pages, read_mask, \
+    save_images_in_place, print_progress, prepare_mask, needs_blend_estimate, estimate_watermark_blend, \
+    propose_watermark_mask, get_color_histograms, tune_color_ranges
+
+
+class HeadlessController:
+    """
+    Runs load -> remove -> save without a GUI, using a mask saved with
+    MaskModel.save_mask (or an automatically proposed one) and an optional
+    per-page parameter file.
+
+    The pages are streamed through the pipeline, so only a few of them are
+    in memory at a time, whatever the document length.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.raster_cache = RasterCache(os.path.join(args.cache_dir, 'rasters')) if args.cache_dir else None
+        self.page_cache = ProcessedPageCache(os.path.join(args.cache_dir, 'pages')) if args.cache_dir else None
+
+    def iter_pages(self, dpi=None):
+        # The low resolution passes render the pages, the full-size pages of a scan are its images
+        return iter_pdf_pages(self.args.pdf_path, dpi or self.args.dpi, cache=self.raster_cache,
+                              workers=self.args.workers, extract_images=dpi is None)
+
+    def run(self):
+        if not os.path.isfile(self.args.pdf_path):
+            raise FileNotFoundError(f"PDF not found: {self.args.pdf_path}")
+        save_path, _ = os.path.splitext(self.args.save_path)
+        # The open document can not be overwritten, this would only fail after all the processing
+        if os.path.exists(f'{save_path}.pdf') and os.path.samefile(f'{save_path}.pdf', self.args.pdf_path):
+            raise ValueError("The output must not be the input PDF, choose another --save_path.")
+        total_pages = get_page_count(self.args.pdf_path)
+        if self.args.mask_path:
+            mask = read_mask(self.args.mask_path)
+        else:
+            print("No mask given, proposing one from the pages")
+            mask = propose_watermark_mask(self.iter_pages(min(self.args.dpi, AUTO_MASK_DPI)))
+
+        if self.args.params_path:
+            parameters = load_parameters(self.args.params_path, total_pages)
+        else:
+            parameters = [ParamsForRemoval() for _ in range(total_pages)]
+
+        if self.args.auto_tune:
+            print("Tuning the color ranges")
+            self.tune_color_ranges(mask, parameters)
+
+        print(f"Processing PDF: {os.path.basename(self.args.pdf_path)}")
+        if needs_blend_estimate(parameters):
+            # The blend is estimated in a first pass over the pages, the pages are not kept in memory
+            pages = self.iter_pages()
+            first_page = next(pages)
+            mask = prepare_mask(mask, first_page.shape)
+            print("Estimating the watermark blend")
+            estimate_watermark_blend(itertools.chain([first_page], pages), mask, parameters)
+        pages = self.iter_pages()
+        options = RemovalOptions(self.args.sharpen_mask_only, self.args.fill_from_vicinity)
+        changed = []
+        processed_pages = iter_removed_pages(pages, mask, parameters, print_progress, self.args.workers, total_pages,
+                                             options, self.page_cache, changed)
+
+        # The images of a scan are replaced in a copy of the document, other documents are rebuilt
+        save_images_in_place(processed_pages, self.args.pdf_path, save_path, changed=changed)
+
+    def tune_color_ranges(self, mask, parameters):
+        # The histograms hardly depend on the resolution, a low resolution pass is enough
+        pages = self.iter_pages(min(self.args.dpi, AUTO_MASK_DPI))
+        first_page = next(pages)
+        prepared_mask = prepare_mask(mask, first_page.shape)
+        histograms = np.stack([get_color_histograms(page, prepared_mask)
+                               for page in itertools.chain([first_page], pages)])
+        set_color_ranges(parameters, *tune_color_ranges(histograms))
@@ -6,6 +6,7 @@ from modules.controller.constants import MaskMode
 
 from modules.controller.constants import CursorType
 from modules.model.base_model import BaseModel
+from modules.utils import propose_watermark_mask
 
 
 class MaskManipulator:
@@ -76,6 +77,12 @@ class MaskManipulator:
                                                             self.model.mask_model.get_temp_mask_after_threshold()))
         self.model.mask_model.reset_temp_mask()
 
+    def auto_mask(self) -> None:
+        # The proposal replaces the mask, it can be undone
+        proposed_mask = propose_watermark_mask(self.model.image_model.get_resized_images())
+        self.model.mask_model.set_final_mask(proposed_mask)
+        self.model.mask_model.reset_temp_mask()
+
     def save_state(self):
         self.model.save_state()
 
@@ -66,4 +66,12 @@ class FileHandlerInterface(ABC):
 
     @abstractmethod
     def save_mask(self) -> None:
-        pass
\ No newline at end of file
+        pass
+
+    @abstractmethod
+    def load_parameters(self) -> None:
+        pass
+
+    @abstractmethod
+    def save_parameters(self) -> None:
+        pass
@@ -0,0 +1,236 @@
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+# Values counted per step when a page is added or removed, small so that the bins stay in the CPU cache
+_COUNT_CHUNK = 4096
+# Bytes of the page stack read per median step, the same chunk is compared four times
+_SELECT_BYTES = 1024 * 1024
+
+
+class MedianAccumulator:
+    """
+    Per-pixel median of a stack of uint8 images that can grow and shrink one page at a time.
+
+    Every pixel (and channel) keeps 16 coarse bins that count its values in steps of 16, and
+    the pages themselves are kept in a stack, so a value costs 16 + N bytes for N pages.
+    Adding or removing a page changes one coarse bin per value, so moving from N to N + 5
+    pages costs only the five new pages. The median is found by a cumulative scan of the
+    coarse bins, then by a binary search of the 16 values of its bin over the page stack.
+    The counts are uint8, so at most 255 pages can be added.
+    """
+    MAX_COUNT = 255
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.size = int(np.prod(self.shape, dtype=np.int64))
+        # Ordered by coarse bin, then by value: the coarse bins are scanned one bin at a time for all the values
+        self._coarse = np.zeros(16 * self.size, np.uint8)
+        # One row per page, it grows when a page is added to a full stack
+        self._stack = np.empty((0, self.size), np.uint8)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self) -> int:
+        return self._coarse.nbytes + self._stack.nbytes
+
+    def _chunks(self, step):
+        for start in range(0, self.size, step):
+            yield slice(start, min(start + step, self.size))
+
+    def _count(self, values: np.ndarray, remove: bool = False) -> None:
+        for chunk in self._chunks(_COUNT_CHUNK):
+            # Every value of a page falls into a different histogram, so the indices are unique
+            coarse_index = (values[chunk].astype(np.int64) >> 4) * self.size + np.arange(chunk.start, chunk.stop)
+            if remove:
+                self._coarse[coarse_index] -= 1
+            else:
+                self._coarse[coarse_index] += 1
+
+    def _reserve(self, pages: int) -> None:
+        if pages > len(self._stack):
+            # Some room to spare, the trackbar usually moves a few pages at a time
+            stack = np.empty((min(max(pages, 8, len(self._stack) * 5 // 4), self.MAX_COUNT), self.size), np.uint8)
+            stack[:self.count] = self._stack[:self.count]
+            self._stack = stack
+
+    def add(self, image: np.ndarray) -> None:
+        if self.count == self.MAX_COUNT:
+            raise ValueError(f"The accumulator holds at most {self.MAX_COUNT} images.")
+        if image.shape != self.shape:
+            raise ValueError(f"Image shape {image.shape} does not match the accumulator shape {self.shape}.")
+        self._reserve(self.count + 1)
+        self._stack[self.count] = image.reshape(-1)
+        self._count(self._stack[self.count])
+        self.count += 1
+
+    def remove(self) -> None:
+        """Remove the page that was added last."""
+        if self.count == 0:
+            raise ValueError("The accumulator is empty.")
+        self._count(self._stack[self.count - 1], remove=True)
+        self.count -= 1
+
+    def _select(self, chunk: slice, ranks: Tuple[int, ...]) -> List[np.ndarray]:
+        """The values of the given ranks (0 is the smallest) of every pixel of the chunk."""
+        cumsum = np.zeros(chunk.stop - chunk.start, np.uint16)
+        coarse_bins = [np.zeros(chunk.stop - chunk.start, np.uint8) for _ in ranks]
+        for i in range(16):
+            cumsum += self._coarse[i * self.size + chunk.start:i * self.size + chunk.stop]
+            for rank, coarse_bin in zip(ranks, coarse_bins):
+                coarse_bin += cumsum <= rank
+        # The largest value with at most ``rank`` smaller values, searched bit by bit inside the coarse bin
+        pages = self._stack[:self.count, chunk]
+        is_below = np.empty(pages.shape, bool)
+        values = []
+        for rank, coarse_bin in zip(ranks, coarse_bins):
+            value = coarse_bin * np.uint8(16)
+            for bit in (8, 4, 2, 1):
+                np.less(pages, value + np.uint8(bit), out=is_below)
+                # At most 255 pages, the counts fit in uint8
+                below = is_below.view(np.uint8).sum(axis=0, dtype=np.uint8)
+                value += np.uint8(bit) * (below <= rank)
+            values.append(value)
+        return values
+
+    def median(self) -> np.ndarray:
+        if self.count == 0:
+            raise ValueError("The accumulator is empty.")
+        middle = self.count // 2
+        result = np.empty(self.size, np.uint8)
+        for chunk in self._chunks(max(1024, _SELECT_BYTES // self.count)):
+            if self.count % 2:
+                result[chunk] = self._select(chunk, (middle,))[0]
+            else:
+                # Same result as np.uint8(np.median(...)): the mean of the two middle values, rounded down
+                lower, upper = self._select(chunk, (middle - 1, middle))
+                result[chunk] = (lower.astype(np.uint16) + upper) // 2
+        return result.reshape(self.shape)
+
+    def update(self, images, length: int, stopped=None) -> None:
+        """
+        Add or remove pages so that the accumulator holds the first ``length`` images.
+        ``stopped`` is called between the pages, the update ends early when it returns True.
+        """
+        length = min(length, len(images))
+        self._reserve(length)
+        while self.count != length and not (stopped is not None and stopped()):
+            if self.count < length:
+                self.add(images[self.count])
+            else:
+                self.remove()
+
+
+class MedianImageCache:
+    """
+    Thread-safe LRU cache of median images, limited by the total size of the stored images
+    and of the ``reserved`` bytes used elsewhere from the same budget.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._reserved = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: int) -> Optional[np.ndarray]:
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def put(self, key: int, image: np.ndarray) -> None:
+        with self._lock:
+            if key in self._images:
+                self._bytes -= self._images.pop(key).nbytes
+            self._images[key] = image
+            self._bytes += image.nbytes
+            self._evict()
+
+    def reserve(self, nbytes: int) -> None:
+        with self._lock:
+            self._reserved = nbytes
+            self._evict()
+
+    def _evict(self) -> None:
+        # Evict the least recently used images, but always keep the newest one
+        while self._bytes + self._reserved > self.max_bytes and len(self._images) > 1:
+            _, evicted = self._images.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def nearest(self, key: int) -> Optional[Tuple[int, np.ndarray]]:
+        with self._lock:
+            if not self._images:
+                return None
+            nearest_key = min(self._images, key=lambda k: abs(k - key))
+            return nearest_key, self._images[nearest_key]
+
+    def __contains__(self, key: int) -> bool:
+        with self._lock:
+            return key in self._images
+
+
+class MedianPrecomputer:
+    """
+    Computes median images in a background thread and stores them in a MedianImageCache.
+
+    The thread owns a MedianAccumulator, so consecutive positions only cost the pages
+    between them, and its memory is taken from the budget of the cache. The most recent
+    request is served first.
+    """
+    def __init__(self, images, cache: MedianImageCache, max_length: int):
+        self.images = images
+        self.cache = cache
+        self.max_length = max_length
+        self.accumulator = MedianAccumulator(images[0].shape)
+        self._lock = threading.Lock()
+        self._pending: List[int] = []
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def compute(self, key: int) -> np.ndarray:
+        """Compute the median of the first ``key`` images now (or return it from the cache), None once stopped."""
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+        with self._lock:
+            self.accumulator.update(self.images, min(key, self.max_length), lambda: self._stopped)
+            self.cache.reserve(self.accumulator.nbytes)
+            if self._stopped:
+                return None
+            image = self.accumulator.median()
+        self.cache.put(key, image)
+        return image
+
+    def request(self, keys: List[int]) -> None:
+        """Replace the queued positions, the first key is computed first."""
+        with self._wakeup:
+            self._pending = [key for key in keys if key not in self.cache]
+            self._wakeup.notify()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._pending = []
+            self._wakeup.notify()
+
+    def join(self) -> None:
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._pending and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                key = self._pending.pop(0)
+            self.compute(key)
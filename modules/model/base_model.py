@@ -1,23 +1,40 @@
+import zlib
+
 import cv2
 import numpy as np
 
-from modules.controller.constants import MaskMode, CursorType
+from modules.color_index import PageColorIndex
+from modules.controller.constants import MaskMode, CursorType, MEDIAN_CACHE_BYTES, RemovalMode, RANGE_HIGHLIGHT_COLOR, \
+    PREVIEW_BLEND_PAGES
 from modules.interfaces.interfaces import RedoUndoInterface
 from modules.model.config_model import ConfigModel
 from modules.model.cursor_model import CursorModel
 from modules.model.image_model import ImageModel
+from modules.page_cache import RasterCache
 from modules.model.mask_model import MaskModel
 from modules.model.parameter_model import ParameterModel
-from modules.utils import fill_masked_area, inpaint_image, sharpen_image
+from modules.utils import add_texts_to_image, PreparedMask, get_fill_color, prepare_mask, fill_watermark, \
+    sharpen_filled_image, estimate_watermark_blend, get_color_histograms, tune_color_ranges
 
 
 class BaseModel(RedoUndoInterface):
-    def __init__(self, path=None, dpi=200, max_width=1920, max_height=1080):
+    def __init__(self, path=None, dpi=200, max_width=1920, max_height=1080, median_cache_bytes=MEDIAN_CACHE_BYTES,
+                 raster_cache: RasterCache = None, workers: int = 1):
         self.config_model = ConfigModel()
-        self.image_model = ImageModel(path, max_width, max_height, dpi)
+        self.image_model = ImageModel(path, max_width, max_height, dpi, median_cache_bytes, raster_cache, workers)
         self.mask_model = MaskModel(self.image_model.get_image_shape())
         self.cursor_model = CursorModel()
         self.parameter_model = ParameterModel(self.image_model)
+        # Most frequent color of the shown images, it does not change when the parameters change
+        self.fill_color_cache = {}
+        # Watermark blend estimated from all shown images, only the latest one is kept. It takes seconds,
+        # so it is only estimated again for a new mask or document, or on request (see estimate_watermark_blend)
+        self.blend_cache = {}
+        self.blend_version = 0
+        # Color indexes of the shown images for the current mask
+        self.color_index_cache = {}
+        # Latest (key, result) of every stage of the preview, see get_processed_current_image
+        self.preview_cache = {}
 
     def update_data(self, images):
         self.image_model.update_data(images)
@@ -70,27 +87,109 @@ class BaseModel(RedoUndoInterface):
     def get_bgr_mask(self) -> np.ndarray:
         return self.mask_model.get_bgr_mask(self.config_model.get_mode())
 
+    def get_fill_color(self, image: np.ndarray, prepared_mask: PreparedMask) -> np.ndarray:
+        options = self.config_model.get_removal_options()
+        # The vicinity depends on the mask, the whole page color does not
+        mask_key = zlib.crc32(prepared_mask.gray) if options.fill_from_vicinity else None
+        key = (self.image_model.get_current_image_key(), mask_key)
+        if key not in self.fill_color_cache:
+            self.fill_color_cache[key] = get_fill_color(image, prepared_mask, options)
+        return self.fill_color_cache[key]
+
+    def set_watermark_blend(self, prepared_mask: PreparedMask) -> None:
+        # The color ranges at the time of the estimate are used, changing them does not estimate it again
+        key = (self.image_model.image_data.data_version, zlib.crc32(prepared_mask.gray), self.blend_version)
+        if key not in self.blend_cache:
+            self.blend_cache.clear()
+            estimate_watermark_blend(self.image_model.get_resized_images(), prepared_mask,
+                                     self.parameter_model.get_parameters(), PREVIEW_BLEND_PAGES)
+            self.blend_cache[key] = prepared_mask.alpha, prepared_mask.color
+        prepared_mask.alpha, prepared_mask.color = self.blend_cache[key]
+
+    def estimate_watermark_blend(self) -> None:
+        """Estimate the blend again with the current color ranges, when it is used next."""
+        self.blend_version += 1
+
+    def auto_tune_parameters(self) -> None:
+        images = self.image_model.get_resized_images()
+        prepared_mask = prepare_mask(self.get_bgr_mask(), images[0].shape)
+        histograms = np.stack([get_color_histograms(image, prepared_mask) for image in images])
+        if self.parameter_model.get_apply_same_parameters():
+            # One range for the whole document
+            histograms = np.broadcast_to(histograms.sum(axis=0), histograms.shape)
+        self.parameter_model.set_color_ranges(*tune_color_ranges(histograms))
+        # The blend is estimated again with the tuned ranges
+        self.blend_version += 1
+
+    def get_color_index(self, image: np.ndarray) -> PageColorIndex:
+        gray_mask = cv2.cvtColor(self.get_bgr_mask(), cv2.COLOR_BGR2GRAY)
+        mask_key = zlib.crc32(gray_mask)
+        if self.color_index_cache.get('mask_key') != mask_key:
+            self.color_index_cache = {'mask_key': mask_key}
+        key = self.image_model.get_current_image_key()
+        if key not in self.color_index_cache:
+            self.color_index_cache[key] = PageColorIndex(image, np.flatnonzero(gray_mask))
+        return self.color_index_cache[key]
+
+    def get_range_preview_image(self) -> np.ndarray:
+        """The current image with the masked pixels in the color range highlighted, without removing anything."""
+        current_image = self.image_model.get_current_image()
+        parameters = self.parameter_model.get_current_parameters()
+        lower = (parameters.b_min, parameters.g_min, parameters.r_min)
+        upper = (parameters.b_max, parameters.g_max, parameters.r_max)
+        color_index = self.get_color_index(current_image)
+
+        preview = current_image.copy()
+        flat_preview = preview.reshape(-1, 3)
+        highlighted = color_index.indices[color_index.in_range(lower, upper)]
+        flat_preview[highlighted] = flat_preview[highlighted] // 2 + np.array(RANGE_HIGHLIGHT_COLOR, np.uint8) // 2
+
+        count = color_index.count(lower, upper)
+        share = 100 * count / max(1, len(color_index))
+        return add_texts_to_image(preview, [f"In range: ~{count} pixels ({share:.1f}% of the mask)"], (10, 30),
+                                  (255, 255, 255))
+
+    def get_cached_stage(self, stage: str, key, compute):
+        # Only the latest result of every stage is kept, it is reused while its inputs do not change
+        cached = self.preview_cache.get(stage)
+        if cached is None or cached[0] != key:
+            cached = key, compute()
+            self.preview_cache[stage] = cached
+        return cached[1]
+
     def get_processed_current_image(self) -> np.ndarray:
+        """
+        The preview of the current image, built in stages: prepared mask -> filled image -> sharpened
+        image. Every stage is cached by its inputs, so e.g. changing only w does not fill again.
+        """
+        image_key = self.image_model.get_current_image_key()
         current_image = self.image_model.get_current_image()
-        lower = np.array([self.parameter_model.get_current_parameters().b_min,
-                          self.parameter_model.get_current_parameters().g_min,
-                          self.parameter_model.get_current_parameters().r_min], dtype=np.uint8)
-        upper = np.array([self.parameter_model.get_current_parameters().b_max,
-                          self.parameter_model.get_current_parameters().g_max,
-                          self.parameter_model.get_current_parameters().r_max], dtype=np.uint8)
+        parameters = self.parameter_model.get_current_parameters()
+        options = self.config_model.get_removal_options()
 
         bgr_mask = self.get_bgr_mask()
-        mask = cv2.bitwise_and(current_image, bgr_mask)
-        gray_mask = cv2.inRange(mask, lower, upper)
-        gray_mask = cv2.bitwise_and(gray_mask, cv2.cvtColor(bgr_mask, cv2.COLOR_BGR2GRAY))
-
-        if self.parameter_model.get_current_parameters().mode:
-            processed_image = fill_masked_area(current_image, gray_mask)
-        else:
-            processed_image = inpaint_image(current_image, gray_mask)
-
-        processed_image = sharpen_image(processed_image, self.parameter_model.get_current_parameters().w / 10)
-        return processed_image
+        mask_key = (zlib.crc32(bgr_mask), current_image.shape)
+        prepared_mask = self.get_cached_stage('mask', mask_key, lambda: prepare_mask(bgr_mask, current_image.shape))
+
+        fill_key = (image_key, mask_key, parameters.mode, tuple(parameters.get_parameters()[:6]),
+                    parameters.inpaint_method, parameters.levels, options.fill_from_vicinity)
+        if parameters.mode == RemovalMode.ALPHA_UNBLEND:
+            fill_key += (self.blend_version,)
+        filled_image = self.get_cached_stage('filled', fill_key,
+                                             lambda: self.fill_current_image(current_image, prepared_mask, parameters))
+
+        sharpen_key = (fill_key, parameters.w, options.sharpen_mask_only)
+        return self.get_cached_stage('sharpened', sharpen_key,
+                                     lambda: sharpen_filled_image(filled_image, prepared_mask, parameters.w, options))
+
+    def fill_current_image(self, current_image, prepared_mask, parameters) -> np.ndarray:
+        fill_color = None
+        if parameters.mode == RemovalMode.MOST_COMMON_COLOR:
+            fill_color = self.get_fill_color(current_image, prepared_mask)
+        elif parameters.mode == RemovalMode.ALPHA_UNBLEND:
+            self.set_watermark_blend(prepared_mask)
+        return fill_watermark(current_image, prepared_mask, parameters, self.config_model.get_removal_options(),
+                              fill_color)
 
     # RedoUndoInterface delegation
     def undo(self) -> None:
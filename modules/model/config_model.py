@@ -1,6 +1,7 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 from modules.controller.constants import MaskMode
+from modules.utils import RemovalOptions
 
 
 @dataclass
@@ -9,6 +10,7 @@ class ConfigData:
     # threshold_min: int = 1
     # threshold_max: int = 225
     weight: float = 0.45
+    removal_options: RemovalOptions = field(default_factory=RemovalOptions)
     # apply_same_parameters: bool = True
 
 
@@ -28,6 +30,12 @@ class ConfigModel:
     def set_weight(self, weight: float):
         self.config_data.weight = weight
 
+    def get_removal_options(self) -> RemovalOptions:
+        return self.config_data.removal_options
+
+    def set_removal_options(self, options: RemovalOptions):
+        self.config_data.removal_options = options
+
     # def get_threshold_min(self) -> int:
     #     return self.config_data.threshold_min
     #
@@ -1,49 +1,100 @@
+import atexit
+import os
+
 import cv2
 import numpy as np
-from typing import List, Optional, Tuple
+from typing import List, Optional, Sequence, Tuple
 from dataclasses import dataclass, field
-from modules.utils import calc_median_image, resize_images, load_pdf
+from modules.controller.constants import MAX_MEDIAN_IMAGE_NUMBER, MEDIAN_CACHE_BYTES, PREVIEW_CACHE_BYTES, \
+    PREFETCH_PAGES
+from modules.median import MedianImageCache, MedianPrecomputer
+from modules.page_cache import RasterCache
+from modules.pages import PdfPages, PreviewPages
+from modules.utils import get_blank_image
 
 
 @dataclass
 class ImageData:
-    images: List[np.ndarray] = field(default_factory=list)
-    original_sized_images: Optional[List[np.ndarray]] = None
+    # Both are sequences of pages, the pages of a PDF are only rendered when they are accessed
+    images: Sequence[np.ndarray] = field(default_factory=list)
+    original_sized_images: Optional[Sequence[np.ndarray]] = None
     current_image: Optional[np.ndarray] = None
     median_image_bgr: Optional[np.ndarray] = None
     median_image_gray: Optional[np.ndarray] = None
     current_page_index: int = 0
+    data_version: int = 0
     median_trackbar_pos: int = 1
-    median_image_cache: dict = field(default_factory=dict)
+    median_image_key: int = 1
+    median_image_cache: Optional[MedianImageCache] = None
+    median_precomputer: Optional[MedianPrecomputer] = None
+    median_cache_bytes: int = MEDIAN_CACHE_BYTES
     max_width: int = 1920
     max_height: int = 1080
     dpi: int = 200
+    raster_cache: Optional[RasterCache] = None
+    # The document the pages were loaded from, it stays the same when the pages are processed
+    pdf_pages: Optional[PdfPages] = None
+    # Which pages differ from the pages of the document, after the watermark was removed
+    changed_pages: Optional[List[bool]] = None
+    workers: int = 1
 
 
 
 class ImageModel:
-    def __init__(self, path, max_width=1920, max_height=1080, dpi=200):
-        self.image_data = ImageData(max_width=max_width, max_height=max_height, dpi=dpi)
+    def __init__(self, path, max_width=1920, max_height=1080, dpi=200, median_cache_bytes=MEDIAN_CACHE_BYTES,
+                 raster_cache: RasterCache = None, workers: int = 1):
+        self.image_data = ImageData(max_width=max_width, max_height=max_height, dpi=dpi,
+                                    median_cache_bytes=median_cache_bytes, raster_cache=raster_cache,
+                                    workers=workers)
         self.load_images(path)
-
-    def update_data(self, images: List[np.ndarray]) -> None:
+        atexit.register(self.stop_background_threads)
+
+    def update_data(self, images: Sequence[np.ndarray]) -> None:
+        """Show the pages, either a list of images or a PdfPages that renders them on demand."""
+        self.image_data.data_version += 1
+        if isinstance(images, PdfPages):
+            self.image_data.pdf_pages = images
+            self.image_data.changed_pages = [False] * len(images)
         self.image_data.original_sized_images = images
-        self.image_data.images = resize_images(images, self.image_data.max_width, self.image_data.max_height)
-        self.image_data.median_image_cache = {}
+        # Nothing may render the old pages any more
+        self.stop_background_threads()
+        self.image_data.images = PreviewPages(images, self.image_data.max_width, self.image_data.max_height,
+                                              PREVIEW_CACHE_BYTES)
+        self.image_data.median_image_cache = MedianImageCache(self.image_data.median_cache_bytes)
+        self.image_data.median_precomputer = MedianPrecomputer(self.image_data.images,
+                                                               self.image_data.median_image_cache,
+                                                               MAX_MEDIAN_IMAGE_NUMBER)
+        self.update_median_image()
 
-        self.image_data.median_image_bgr = calc_median_image(self.image_data.images, self.get_median_trackbar_pos())
-        self.image_data.median_image_gray = cv2.cvtColor(self.image_data.median_image_bgr, cv2.COLOR_BGR2GRAY)
-        self.update_current_image()
+    def stop_background_threads(self) -> None:
+        # OpenCV aborts the process if a background thread is still resizing a page while the interpreter shuts down
+        for worker in (self.image_data.images, self.image_data.median_precomputer):
+            if isinstance(worker, (PreviewPages, MedianPrecomputer)):
+                worker.stop()
+                worker.join()
 
     def update_current_image(self):
         if self.image_data.median_trackbar_pos == 1:
             self.image_data.current_image = self.image_data.images[self.image_data.current_page_index].copy()
         else:
             self.image_data.current_image = self.image_data.median_image_bgr.copy()
+        self.prefetch_pages()
+
+    def prefetch_pages(self) -> None:
+        # The pages next to the current one are likely shown next, the following one first
+        index = self.image_data.current_page_index
+        offsets = sorted(range(-PREFETCH_PAGES, PREFETCH_PAGES + 1), key=lambda offset: (abs(offset), offset < 0))
+        self.image_data.images.prefetch([index + offset for offset in offsets if offset])
 
     def load_images(self, path: str) -> None:
+        """Open the PDF, the pages are rendered when they are shown (or exported) for the first time."""
+        try:
+            print(f"Loading PDF: {os.path.basename(path)}")
+            images = PdfPages(path, self.image_data.dpi, self.image_data.raster_cache, self.image_data.workers)
+        except Exception as e:
+            print(f"Error reading PDF: {e}")
+            images = [get_blank_image()]
         try:
-            images = load_pdf(path, self.image_data.dpi)
             self.update_data(images)
             return True
         except Exception as e:
@@ -54,9 +105,17 @@ class ImageModel:
         if self.image_data.median_trackbar_pos == 1:
             image = self.image_data.images[self.image_data.current_page_index]
         else:
+            self.refresh_median_image()
             image = self.image_data.median_image_bgr
         return image
 
+    def get_current_image_key(self) -> tuple:
+        """Identifies the image returned by get_current_image, e.g. for caching results computed from it."""
+        if self.image_data.median_trackbar_pos == 1:
+            return self.image_data.data_version, 'page', self.image_data.current_page_index
+        self.refresh_median_image()
+        return self.image_data.data_version, 'median', self.image_data.median_image_key
+
     def get_current_image_gray(self) -> np.ndarray:
         if self.image_data.current_image is not None:
             return cv2.cvtColor(self.image_data.current_image, cv2.COLOR_BGR2GRAY)
@@ -88,23 +147,51 @@ class ImageModel:
     def get_median_trackbar_pos(self) -> int:
         return self.image_data.median_trackbar_pos
 
-    def update_median_image(self) -> None:
-        tb_pos = self.get_median_trackbar_pos()
+    @staticmethod
+    def get_median_key(tb_pos: int) -> int:
+        # Above 10 the median images are calculated only for every 5th position
         if tb_pos > 10:
             if tb_pos % 10 < 5:
                 tb_pos = (tb_pos // 10) * 10 + 5
             else:
                 tb_pos = ((tb_pos + 5) // 10) * 10
+        return tb_pos
 
-        if tb_pos in self.image_data.median_image_cache:
-            self.image_data.median_image_bgr = self.image_data.median_image_cache[tb_pos]
-        else:
-            median_img = calc_median_image(self.image_data.images, tb_pos)
-            self.image_data.median_image_cache[tb_pos] = median_img
-            self.image_data.median_image_bgr = median_img
+    def get_likely_median_keys(self, key: int, count: int = 8) -> List[int]:
+        max_key = self.get_median_key(min(self.get_number_of_pages(), MAX_MEDIAN_IMAGE_NUMBER))
+        keys = [k for k in list(range(1, 11)) + list(range(15, max_key + 1, 5)) if k <= max_key]
+        return sorted(keys, key=lambda k: abs(k - key))[:count]
+
+    def update_median_image(self) -> None:
+        key = self.get_median_key(self.get_median_trackbar_pos())
+        shown_key = key
+
+        median_img = self.image_data.median_image_cache.get(key)
+        if median_img is None:
+            # Show the nearest ready median image, the exact one is calculated in the background
+            nearest = self.image_data.median_image_cache.nearest(key)
+            if nearest is None:
+                median_img = self.image_data.median_precomputer.compute(key)
+            else:
+                shown_key, median_img = nearest
+        self.image_data.median_precomputer.request(self.get_likely_median_keys(key))
+
+        self.set_median_image(shown_key, median_img)
+
+    def set_median_image(self, key: int, median_img: np.ndarray) -> None:
+        self.image_data.median_image_key = key
+        self.image_data.median_image_bgr = median_img
         self.image_data.median_image_gray = cv2.cvtColor(self.image_data.median_image_bgr, cv2.COLOR_BGR2GRAY)
         self.update_current_image()
 
+    def refresh_median_image(self) -> None:
+        # Swap in the exact median image once the background worker has finished it
+        key = self.get_median_key(self.get_median_trackbar_pos())
+        if key != self.image_data.median_image_key:
+            median_img = self.image_data.median_image_cache.get(key)
+            if median_img is not None:
+                self.set_median_image(key, median_img)
+
     def get_current_page_index(self) -> int:
         return self.image_data.current_page_index
 
@@ -114,6 +201,19 @@ class ImageModel:
     def get_original_sized_images(self) -> List[np.ndarray]:
         return self.image_data.original_sized_images
 
+    def get_pdf_pages(self) -> Optional[PdfPages]:
+        return self.image_data.pdf_pages
+
+    def mark_changed_pages(self, changed: List[bool]) -> None:
+        """Record the pages changed by a removal, a page stays changed when it is processed again."""
+        if self.image_data.changed_pages is None or len(self.image_data.changed_pages) != len(changed):
+            self.image_data.changed_pages = list(changed)
+        else:
+            self.image_data.changed_pages = [a or b for a, b in zip(self.image_data.changed_pages, changed)]
+
+    def get_changed_pages(self) -> Optional[List[bool]]:
+        return self.image_data.changed_pages
+
     def get_resized_images(self) -> List[np.ndarray]:
         return self.image_data.images
 
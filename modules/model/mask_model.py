@@ -6,7 +6,7 @@ import numpy as np
 
 from modules.controller.constants import MaskMode
 from modules.interfaces.interfaces import RedoUndoInterface
-from modules.utils import resize_mask
+from modules.utils import read_mask, resize_mask
 
 
 class State:
@@ -74,9 +74,7 @@ class MaskModel(RedoUndoInterface):
 
     def load_mask(self, path, shape) -> bool:
         try:
-            loaded_mask = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-            if len(loaded_mask.shape) == 3 and loaded_mask.shape[2] == 3:
-                loaded_mask = cv2.cvtColor(loaded_mask, cv2.COLOR_BGR2GRAY)
+            loaded_mask = read_mask(path)
 
             if loaded_mask.shape != shape[:2]:
                 loaded_mask = resize_mask(loaded_mask, shape[1], shape[0])
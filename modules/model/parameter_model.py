@@ -1,6 +1,8 @@
+import json
 from dataclasses import dataclass
 from typing import List, Dict, Any
 
+from modules.controller.constants import RemovalMode
 from modules.model.image_model import ImageModel
 
 
@@ -13,22 +15,65 @@ class ParamsForRemoval:
     b_min: int = 90
     b_max: int = 240
     w: float = 0
-    mode: bool = True
+    mode: int = RemovalMode.MOST_COMMON_COLOR
+    inpaint_method: int = 0
+    levels: int = 0
 
     def get_parameters(self):
-        return [self.r_min, self.r_max, self.g_min, self.g_max, self.b_min, self.b_max, self.w, self.mode]
+        return [self.r_min, self.r_max, self.g_min, self.g_max, self.b_min, self.b_max, self.w, self.mode,
+                self.inpaint_method, self.levels]
 
     def set_parameters(self, args):
-        self.r_min, self.r_max, self.g_min, self.g_max, self.b_min, self.b_max, self.w, self.mode = args
+        self.r_min, self.r_max, self.g_min, self.g_max, self.b_min, self.b_max, self.w, self.mode, \
+            self.inpaint_method, self.levels = args
 
     @staticmethod
     def get_parameter_names():
-        return ['r_min', 'r_max', 'g_min', 'g_max', 'b_min', 'b_max', 'w', 'mode']
+        return ['r_min', 'r_max', 'g_min', 'g_max', 'b_min', 'b_max', 'w', 'mode', 'inpaint_method', 'levels']
 
     def get_params_as_dict(self):
         return {'names': self.get_parameter_names(),
                 'values': self.get_parameters()}
 
+    def to_dict(self):
+        return dict(zip(self.get_parameter_names(), self.get_parameters()))
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**{name: values[name] for name in cls.get_parameter_names() if name in values})
+
+
+def save_parameters(parameters: List[ParamsForRemoval], path: str) -> None:
+    with open(path, 'w') as f:
+        json.dump([params.to_dict() for params in parameters], f, indent=2)
+    print("Parameters saved as " + path)
+
+
+def load_parameters(path: str, number_of_pages: int) -> List[ParamsForRemoval]:
+    """
+    Read per-page removal parameters from a JSON file.
+
+    The file holds either a list with one object per page or a single object
+    that is applied to every page.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) == 1:
+        data = data * number_of_pages
+    if len(data) != number_of_pages:
+        raise ValueError(f"Parameter file has {len(data)} entries, but the document has {number_of_pages} pages.")
+    return [ParamsForRemoval.from_dict(values) for values in data]
+
+
+
+def set_color_ranges(parameters: List[ParamsForRemoval], lower, upper, found) -> None:
+    """Set the color ranges from (pages, 3) BGR bounds (see tune_color_ranges), pages without a range are kept."""
+    for params, (b_min, g_min, r_min), (b_max, g_max, r_max), page_found in zip(parameters, lower, upper, found):
+        if page_found:
+            params.r_min, params.g_min, params.b_min = int(r_min), int(g_min), int(b_min)
+            params.r_max, params.g_max, params.b_max = int(r_max), int(g_max), int(b_max)
 
 
 class ParameterModel:
@@ -58,6 +103,20 @@ class ParameterModel:
     def get_apply_same_parameters(self) -> bool:
         return self.apply_same_parameters
 
+    def save_parameters(self, path: str) -> None:
+        save_parameters(self.parameters, path)
+
+    def load_parameters(self, path: str) -> bool:
+        try:
+            self.parameters = load_parameters(path, self.image_model.get_number_of_pages())
+            return True
+        except Exception as e:
+            print(f"Error loading parameters from {path}. Error: {e}")
+            return False
+
+    def set_color_ranges(self, lower, upper, found) -> None:
+        set_color_ranges(self.parameters, lower, upper, found)
+
     def set_current_parameter(self, attr: str, val: Any) -> None:
         if hasattr(self.get_current_parameters(), attr):
             setattr(self.get_current_parameters(), attr, val)
@@ -0,0 +1,126 @@
+import dataclasses
+import hashlib
+import json
+import os
+from contextlib import contextmanager
+from typing import Optional
+
+import cv2
+import numpy as np
+
+from modules.controller.constants import PAGE_CACHE_VERSION, RemovalMode
+
+
+def _hash_array(digest, array: np.ndarray) -> None:
+    array = np.ascontiguousarray(array)
+    digest.update(f"{array.dtype.str}{array.shape}".encode())
+    digest.update(memoryview(array).cast('B'))
+
+
+@contextmanager
+def _open_for_writing(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written to a temporary file first, so that an interrupted run never leaves a broken file behind
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        yield f
+    os.replace(temp_path, path)
+
+
+class ProcessedPageCache:
+    """
+    Persistent cache of processed pages in a directory, addressed by the content of their input.
+
+    The key of a page is a hash of its pixels, the mask (and its estimated blend), the
+    parameters of the page and the removal options, so a page is only processed again if
+    one of them changed, also in a later session. The pages are stored as PNG (lossless).
+    The directory can be deleted at any time to free the space.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # The mask is the same for every page of a run, it is only hashed once
+        self._mask_digest = None
+
+    def __getstate__(self):
+        # Sent to the worker processes without the digest of the parent's mask
+        return {'directory': self.directory, '_mask_digest': None}
+
+    def _get_mask_digest(self, mask):
+        if self._mask_digest is not None and self._mask_digest[0] is mask:
+            return self._mask_digest[1]
+        gray_digest = hashlib.blake2b(digest_size=16)
+        _hash_array(gray_digest, mask.gray)
+        blend_digest = hashlib.blake2b(gray_digest.digest(), digest_size=16)
+        if mask.alpha is not None:
+            _hash_array(blend_digest, mask.alpha)
+            _hash_array(blend_digest, np.asarray(mask.color, np.float64))
+        self._mask_digest = (mask, (gray_digest.digest(), blend_digest.digest()))
+        return self._mask_digest[1]
+
+    def get_key(self, img: np.ndarray, mask, parameters, options=None) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str(PAGE_CACHE_VERSION).encode())
+        _hash_array(digest, img)
+        # The blend only changes the result of the pages in the alpha unblend mode
+        gray_digest, blend_digest = self._get_mask_digest(mask)
+        digest.update(blend_digest if parameters.mode == RemovalMode.ALPHA_UNBLEND else gray_digest)
+        digest.update(json.dumps(parameters.to_dict(), sort_keys=True).encode())
+        if options is not None:
+            digest.update(json.dumps(dataclasses.asdict(options), sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        # Two levels, so that a directory does not hold too many files
+        return os.path.join(self.directory, key[:2], f"{key}.png")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        path = self._get_path(key)
+        if not os.path.isfile(path):
+            return None
+        return cv2.imread(path, cv2.IMREAD_COLOR)
+
+    def put(self, key: str, image: np.ndarray) -> None:
+        ok, data = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if ok:
+            with _open_for_writing(self._get_path(key)) as f:
+                f.write(data.tobytes())
+
+
+class RasterCache:
+    """
+    Persistent cache of rendered PDF pages in a directory, addressed by the content of the
+    PDF, the page number and the resolution.
+
+    The pages are stored as raw .npy arrays and memory-mapped when they are read, so reopening
+    a document is nearly free and the pages are only paged into memory when they are used.
+    The arrays are mapped copy-on-write: changing a page in memory never changes the cache.
+    The directory can be deleted at any time to free the space.
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def get_document_key(pdf_path: str) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(pdf_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _get_path(self, document_key: str, page_num: int, dpi: int) -> str:
+        return os.path.join(self.directory, document_key, str(dpi), f"{page_num}.npy")
+
+    def get(self, document_key: str, page_num: int, dpi: int) -> Optional[np.ndarray]:
+        path = self._get_path(document_key, page_num, dpi)
+        if not os.path.isfile(path):
+            return None
+        return np.load(path, mmap_mode='c')
+
+    def put(self, document_key: str, page_num: int, dpi: int, image: np.ndarray) -> np.ndarray:
+        """Store the page and return it memory-mapped from the cache."""
+        path = self._get_path(document_key, page_num, dpi)
+        with _open_for_writing(path) as f:
+            np.save(f, np.ascontiguousarray(image))
+        return np.load(path, mmap_mode='c')
@@ -0,0 +1,109 @@
+from collections.abc import Sequence
+from multiprocessing import shared_memory
+from typing import Tuple
+
+import numpy as np
+
+
+class PageStack(Sequence):
+    """
+    Pages of the same shape in one preallocated (N, H, W, 3) uint8 array, every page is a view into it.
+
+    The array is either in memory, in a memory-mapped .npy file (``path``) or in shared memory
+    (``shared``). A file-backed or shared stack is pickled as its location, so it can be sent to
+    worker processes without copying the pages. A shared stack has to be closed by its creator,
+    the pages must not be used after that.
+    """
+    def __init__(self, count: int, shape: Tuple[int, ...], path: str = None, shared: bool = False):
+        self.shape = (count,) + tuple(shape)
+        self.path = path
+        self._shm = None
+        self._owner = True
+        if shared:
+            self._shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(self.shape))))
+            self.array = np.ndarray(self.shape, np.uint8, self._shm.buf)
+        elif path is not None:
+            self.array = np.lib.format.open_memmap(path, 'w+', np.uint8, self.shape)
+        else:
+            self.array = np.empty(self.shape, np.uint8)
+
+    @classmethod
+    def from_pages(cls, pages, count: int = None, path: str = None, shared: bool = False) -> 'PageStack':
+        """Copy the pages (any iterable of images of the same shape) into a new stack."""
+        if count is None:
+            count = len(pages)
+        pages = iter(pages)
+        first_page = next(pages)
+        stack = cls(count, first_page.shape, path, shared)
+        stack.array[0] = first_page
+        for i, page in enumerate(pages, 1):
+            stack.array[i] = page
+        return stack
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self.array[index])
+        return self.array[index]
+
+    def __setitem__(self, index, page):
+        self.array[index] = page
+
+    @property
+    def page_shape(self) -> Tuple[int, ...]:
+        return self.shape[1:]
+
+    def __getstate__(self):
+        if self._shm is not None:
+            return {'shape': self.shape, 'name': self._shm.name}
+        if self.path is not None:
+            self.array.flush()
+            return {'shape': self.shape, 'path': self.path}
+        return {'shape': self.shape, 'array': self.array}
+
+    def __setstate__(self, state):
+        self.shape = state['shape']
+        self.path = state.get('path')
+        self._shm = None
+        self._owner = False
+        if 'name' in state:
+            self._shm = shared_memory.SharedMemory(name=state['name'])
+            self.array = np.ndarray(self.shape, np.uint8, self._shm.buf)
+        elif self.path is not None:
+            self.array = np.load(self.path, mmap_mode='r+')
+        else:
+            self.array = state['array']
+
+    def close(self) -> None:
+        """Release the shared memory (and free it, if this is the stack that created it)."""
+        if self._shm is None:
+            return
+        self.array = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stack_pages(pages, count: int):
+    """Gather the pages in a PageStack, or in a list if they do not all have the same shape."""
+    pages = iter(pages)
+    first_page = next(pages, None)
+    if first_page is None:
+        return []
+    stack = PageStack(count, first_page.shape)
+    stack[0] = first_page
+    for i, page in enumerate(pages, 1):
+        if page.shape != stack.page_shape:
+            # Pages of different sizes, e.g. a landscape page in a portrait document
+            return list(stack.array[:i]) + [page] + list(pages)
+        stack[i] = page
+    return stack
@@ -0,0 +1,164 @@
+import threading
+from collections.abc import Sequence
+from typing import List, Tuple
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+from modules.median import MedianImageCache
+from modules.page_cache import RasterCache
+from modules.utils import pixmap_to_bgr, get_resized_shape, iter_pdf_page_images, get_scanned_page_image, \
+    render_page, mupdf_lock
+
+
+class PdfPages(Sequence):
+    """
+    The pages of a PDF as a read-only sequence of BGR images, rendered when they are accessed.
+
+    Nothing is kept in memory, a page is rendered again every time it is accessed (or
+    memory-mapped from ``cache``), so iterating over the pages streams the document.
+    Iterating renders the pages with ``workers`` processes. The pages of a scan are the
+    embedded images at their native resolution (see get_scanned_page_image), not rendered at ``dpi``.
+    Checking every page takes seconds for a long document, so the first page decides if the
+    document is shown as a scan. Indexing and iterating give the same page.
+    """
+    def __init__(self, pdf_path: str, dpi: int, cache: RasterCache = None, workers: int = 1,
+                 extract_images: bool = True):
+        self.pdf_path = pdf_path
+        self.dpi = dpi
+        self.cache = cache
+        self.workers = workers
+        with mupdf_lock:
+            self._doc = fitz.open(pdf_path)
+            self._page_count = len(self._doc)
+            first_page = self._doc.load_page(0)
+            self.scanned = extract_images and get_scanned_page_image(first_page) is not None
+            # The resolution of the full-size pages, the native resolution of the images of a scan
+            self.render_dpi = dpi
+            self._image_size = None
+            if self.scanned:
+                self._image_size = tuple(first_page.get_images(full=True)[0][2:4])
+                self.render_dpi = self._image_size[0] * 72 / first_page.rect.width
+        # The native resolution is cached as DPI 0, like iter_pdf_pages does
+        self._cache_dpi = 0 if self.scanned else dpi
+        self._document_key = cache.get_document_key(pdf_path) if cache is not None else None
+
+    def __len__(self):
+        return self._page_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Page index out of range.")
+        image = self.cache.get(self._document_key, index, self._cache_dpi) if self.cache is not None else None
+        if image is None:
+            with mupdf_lock:
+                image = self._render_page(index)
+            if self.cache is not None:
+                image = self.cache.put(self._document_key, index, self._cache_dpi, image)
+        return image
+
+    def _page_xref(self, page):
+        # The pages of a scan whose image differs from the first page's are rendered at the resolution of the scan
+        return get_scanned_page_image(page, self._image_size) if self.scanned else None
+
+    def _render_page(self, index: int) -> np.ndarray:
+        return render_page(self._doc, index, self.render_dpi, self._page_xref(self._doc.load_page(index)))
+
+    def __iter__(self):
+        with mupdf_lock:
+            xrefs = [self._page_xref(page) for page in self._doc] if self.scanned else None
+        return iter_pdf_page_images(self.pdf_path, xrefs, self.render_dpi, self._cache_dpi, cache=self.cache,
+                                    workers=self.workers)
+
+    def render(self, index: int, dpi: float) -> np.ndarray:
+        with mupdf_lock:
+            page = self._doc.load_page(index)
+            # The preview resolution is not a whole DPI, so the zoom is given instead
+            return pixmap_to_bgr(page.get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72)))
+
+    def get_shape(self, index: int = 0) -> Tuple[int, int, int]:
+        """Shape of the full-size page, without rendering it."""
+        with mupdf_lock:
+            page = self._doc.load_page(index)
+            if self.scanned and get_scanned_page_image(page, self._image_size) is not None:
+                width, height = self._image_size
+                return height, width, 3
+            rect = (page.rect * fitz.Matrix(self.render_dpi / 72, self.render_dpi / 72)).irect
+        return rect.height, rect.width, 3
+
+
+class PreviewPages(Sequence):
+    """
+    Downscaled copies of the pages for the GUI, made when they are accessed.
+
+    The pages of a PdfPages are rendered directly at the preview resolution, other pages
+    (e.g. the processed ones) are resized. Every preview has the size of the first one.
+    The recently used previews are kept in an LRU cache and ``prefetch`` makes the given
+    pages in a background thread, e.g. the neighbours of the current page.
+    """
+    def __init__(self, pages, max_width: int, max_height: int, cache_bytes: int):
+        self.pages = pages
+        full_shape = pages.get_shape(0) if isinstance(pages, PdfPages) else pages[0].shape
+        self.shape = get_resized_shape(full_shape, max_width, max_height)
+        self.scale = self.shape[0] / full_shape[0]
+        self.cache = MedianImageCache(cache_bytes)
+        self._pending: List[int] = []
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Page index out of range.")
+        image = self.cache.get(index)
+        if image is None:
+            image = self._make_preview(index)
+            self.cache.put(index, image)
+        return image
+
+    def _make_preview(self, index: int) -> np.ndarray:
+        if isinstance(self.pages, PdfPages):
+            image = self.pages.render(index, self.pages.render_dpi * self.scale)
+        else:
+            image = self.pages[index]
+        if image.shape[:2] == self.shape[:2]:
+            return image
+        return cv2.resize(image, (self.shape[1], self.shape[0]), interpolation=cv2.INTER_AREA)
+
+    def prefetch(self, indices: List[int]) -> None:
+        """Replace the queued pages, the first one is made first."""
+        with self._wakeup:
+            self._pending = [i for i in indices if 0 <= i < len(self) and i not in self.cache]
+            self._wakeup.notify()
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._pending = []
+            self._wakeup.notify()
+
+    def join(self) -> None:
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._wakeup:
+                while not self._pending and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                index = self._pending.pop(0)
+            self[index]
@@ -1,10 +1,23 @@
+import itertools
 import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
 import cv2
 import numpy as np
 import fitz  # PyMuPDF
 
-from modules.controller.constants import MAX_MEDIAN_IMAGE_NUMBER
+from modules.controller.constants import MAX_MEDIAN_IMAGE_NUMBER, REGION_PADDING, FILL_COLOR_SAMPLE_STEP, \
+    BACKGROUND_TILE_SIZE, RemovalMode, MAX_BLEND_ALPHA, MIN_BLEND_VARIANCE, \
+    MIN_BLEND_CORRELATION, ASSUMED_BLEND_ALPHA, AUTO_MASK_MIN_CONTRAST, AUTO_MASK_MIN_FRACTION, AUTO_MASK_MIN_AREA, \
+    AUTO_TUNE_MIN_EXCESS
+from modules.page_cache import ProcessedPageCache, RasterCache
+from modules.page_stack import PageStack, stack_pages
 
 
 def calc_median_image(images, length: int = 40):
@@ -16,32 +29,97 @@ def calc_median_image(images, length: int = 40):
     return median_image
 
 
-def convert_images(images):
-    return [cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR) for image in images]
-
-
 def sharpen_image(img, w):
+    if w == 0:
+        return img
     im_blur = cv2.GaussianBlur(img, (3, 3), 2.0)
     im_diff = cv2.subtract(img, im_blur, dtype=cv2.CV_16S)
     img = cv2.add(img, w * im_diff, dtype=cv2.CV_8UC1)
     return img
 
-def get_most_frequent_color(image):
-    # Split the image into its channels and get the most frequent color in each channel
-    # TODO: take only the certain vicinity of the masked area into account
-    channels = cv2.split(image)
-    most_frequent_colors = [np.bincount(channel.flatten()).argmax() for channel in channels]
-    return np.array(most_frequent_colors)
-
-def fill_masked_area(image, gray_mask):
-    new_color = get_most_frequent_color(image)
+def get_most_frequent_color(image, indices=None, step=FILL_COLOR_SAMPLE_STEP):
+    """
+    Most frequent BGR color of the image (channels counted together), from every ``step``-th pixel
+    or from the flat pixel ``indices`` if given.
+    """
+    if indices is not None and len(indices):
+        pixels = image.reshape(-1, 3)[indices]
+    else:
+        pixels = image[::step, ::step].reshape(-1, 3)
+    codes = (pixels[:, 0].astype(np.int32) << 16) | (pixels[:, 1].astype(np.int32) << 8) | pixels[:, 2]
+    values, counts = np.unique(codes, return_counts=True)
+    code = values[counts.argmax()]
+    return np.array([(code >> 16) & 255, (code >> 8) & 255, code & 255], dtype=np.uint8)
+
+def fill_masked_area(image, gray_mask, new_color=None):
+    if new_color is None:
+        new_color = get_most_frequent_color(image)
     img = image.copy()
     img[gray_mask == 255] = new_color
     return img
 
-def inpaint_image(image, mask):
-     return cv2.inpaint(image, mask, 2, cv2.INPAINT_TELEA)
-    # return cv2.inpaint(image, mask, 3, cv2.INPAINT_NS)
+def estimate_background(image, known_mask, tile_size=BACKGROUND_TILE_SIZE):
+    """
+    Local background from the known pixels (``known_mask`` != 0): the median of every tile,
+    interpolated back to the image size.
+    """
+    height, width = image.shape[:2]
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+
+    ys, xs = np.nonzero(known_mask)
+    if len(ys) == 0:
+        return np.broadcast_to(get_most_frequent_color(image), image.shape)
+    pixels = image[ys, xs]
+    tiles = (ys // tile_size) * cols + xs // tile_size
+
+    counts = np.bincount(tiles, minlength=rows * cols)
+    known_tiles = np.where(counts > 0, 255, 0).astype(np.uint8)
+    # Position of the median in the sorted keys of every tile that has known pixels
+    middle = (np.cumsum(counts) - counts + (counts - 1) // 2)[counts > 0]
+    grid = np.zeros((rows * cols, 3), np.uint8)
+    for channel in range(3):
+        keys = np.sort((tiles.astype(np.int64) << 8) | pixels[:, channel])
+        grid[counts > 0, channel] = keys[middle] & 255
+    grid = grid.reshape(rows, cols, 3)
+
+    unknown_tiles = cv2.bitwise_not(known_tiles).reshape(rows, cols)
+    if unknown_tiles.any():
+        grid = cv2.inpaint(grid, unknown_tiles, 2, cv2.INPAINT_TELEA)
+
+    background = cv2.resize(grid, (cols * tile_size, rows * tile_size), interpolation=cv2.INTER_LINEAR)
+    return background[:height, :width]
+
+# (flag, radius) of the inpainting methods, indexed by ParamsForRemoval.inpaint_method
+INPAINT_METHODS = ((cv2.INPAINT_TELEA, 2), (cv2.INPAINT_NS, 3))
+
+def inpaint_image(image, mask, method=0, levels=0):
+    """
+    Inpaint the masked pixels, ``levels`` pyramid levels down if > 0, with only the mask border
+    inpainted again at full resolution.
+    """
+    flag, radius = INPAINT_METHODS[method]
+    # Do not go below a few pixels, there is nothing left to inpaint from
+    while levels > 0 and min(image.shape[:2]) >> levels < 8:
+        levels -= 1
+    if levels <= 0 or not mask.any():
+        return cv2.inpaint(image, mask, radius, flag)
+
+    small_image, small_mask = image, mask
+    for _ in range(levels):
+        small_image, small_mask = cv2.pyrDown(small_image), cv2.pyrDown(small_mask)
+    # Every low resolution pixel that the watermark bleeds into has to be inpainted
+    small_mask = cv2.threshold(small_mask, 0, 255, cv2.THRESH_BINARY)[1]
+    filled = cv2.inpaint(small_image, small_mask, radius, flag)
+
+    height, width = image.shape[:2]
+    upscaled = cv2.resize(filled, (width, height), interpolation=cv2.INTER_LINEAR)
+    result = image.copy()
+    result[mask > 0] = upscaled[mask > 0]
+
+    band_width = radius
+    core = cv2.erode(mask, np.ones((2 * band_width + 1, 2 * band_width + 1), np.uint8))
+    border = cv2.subtract(mask, core)
+    return cv2.inpaint(result, border, radius, flag)
 
 def add_texts_to_image(image, texts, start_pos, color, background_color=(0, 0, 0)):
     if color == (0, 0, 0):
@@ -67,113 +145,775 @@ def draw_progress_bar(image, progress, bar_color=(255, 255, 255), bar_thickness=
     return image
 
 
-def remove_watermark(images, mask, parameters):
-    # check if image and mask sizes are the same
-    if images[0].shape[:2] != mask.shape[:2]:
-        # raise ValueError(f"Image and mask sizes do not match. Image size: {images[0].shape[:2]}, Mask size:{mask.shape[:2]}")
-        mask = cv2.resize(mask, (images[0].shape[1], images[0].shape[0]), interpolation=cv2.INTER_AREA)
-
-    total_images = len(images)
+def show_progress_window(done, total, title='Removing watermark...'):
+    progress = done / total
     progressbar_bg_image = np.zeros((75, 800, 3), np.uint8)
-    processed_images = []
-    for i, img in enumerate(images):
 
-        # Calculate progress
-        progress = (i + 1) / total_images
+    # Draw progress bar on the blank image
+    image_with_progress = draw_progress_bar(progressbar_bg_image, progress)
+    image_with_progress = add_texts_to_image(image_with_progress, [f"Progress: {progress * 100:.2f}%"], (10, 30),
+                                             (255, 255, 255))
+
+    # Show the image with progress bar
+    cv2.imshow(title, image_with_progress)
+    cv2.waitKey(1)
+    if done == total:
+        cv2.destroyWindow(title)
+
+
+def print_progress(done, total, text='Removing watermark'):
+    print(f"\r{text}: page {done}/{total} ({(done / total * 100):.2f}%)", end='', flush=True)
+    if done == total:
+        print()
+
+
+def get_mask_regions(gray_mask, padding=REGION_PADDING):
+    """
+    Padded bounding boxes (x0, y0, x1, y1) of the connected regions of the mask, merged so that they
+    do not overlap.
+    """
+    height, width = gray_mask.shape[:2]
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * padding + 1, 2 * padding + 1))
+    grown_mask = cv2.dilate((gray_mask > 0).astype(np.uint8), kernel)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(grown_mask, connectivity=8)
+    boxes = [[int(x), int(y), int(x + w), int(y + h)] for x, y, w, h, _ in stats[1:count]]
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(len(boxes) - 1, i, -1):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+    return [(max(0, x0), max(0, y0), min(width, x1), min(height, y1)) for x0, y0, x1, y1 in boxes]
+
+
+@dataclass
+class PreparedMask:
+    """
+    Everything derived from the mask alone, shared by all pages and workers. ``alpha`` and ``color``
+    are only set by estimate_watermark_blend.
+    """
+    gray: np.ndarray
+    regions: List[Tuple[int, int, int, int]]
+    indices: np.ndarray
+    vicinity: np.ndarray
+    alpha: Optional[np.ndarray] = None
+    color: Optional[np.ndarray] = None
+    # Regions with a larger padding than ``regions``, by padding
+    padded_regions: Dict[int, List[Tuple[int, int, int, int]]] = field(default_factory=dict)
+
+    def get_regions(self, padding: int) -> List[Tuple[int, int, int, int]]:
+        """The regions of the mask with at least ``padding`` pixels around it, computed once per padding."""
+        if padding <= REGION_PADDING:
+            return self.regions
+        if padding not in self.padded_regions:
+            self.padded_regions[padding] = get_mask_regions(self.gray, padding)
+        return self.padded_regions[padding]
+
+
+@dataclass
+class RemovalOptions:
+    # Sharpen only the crops around the mask instead of the whole page
+    sharpen_mask_only: bool = False
+    # Take the fill color from the vicinity of the mask instead of the whole page
+    fill_from_vicinity: bool = False
+
+
+def prepare_mask(mask, shape, padding=REGION_PADDING) -> PreparedMask:
+    if len(mask.shape) == 3:
+        mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
 
-        # Draw progress bar on the blank image
-        image_with_progress = draw_progress_bar(progressbar_bg_image, progress)
-        image_with_progress = add_texts_to_image(image_with_progress, [f"Progress: {progress * 100:.2f}%"], (10, 30),
-                                                 (255, 255, 255))
+    # check if image and mask sizes are the same
+    if shape[:2] != mask.shape[:2]:
+        # raise ValueError(f"Image and mask sizes do not match. Image size: {shape[:2]}, Mask size:{mask.shape[:2]}")
+        mask = cv2.resize(mask, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+
+    # Resizing blurs the edges of the mask, every touched pixel belongs to it
+    gray = np.where(mask > 0, 255, 0).astype(np.uint8)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * padding + 1, 2 * padding + 1))
+    vicinity = cv2.subtract(cv2.dilate(gray, kernel), gray)
+    return PreparedMask(gray=gray,
+                        regions=get_mask_regions(gray, padding),
+                        indices=np.flatnonzero(gray),
+                        vicinity=np.flatnonzero(vicinity))
+
+
+def get_mask_background(img, mask: PreparedMask):
+    """Local background of the page (see estimate_background) at the pixels of the mask."""
+    background = np.zeros_like(img)
+    for x0, y0, x1, y1 in mask.regions:
+        background[y0:y1, x0:x1] = estimate_background(img[y0:y1, x0:x1],
+                                                       cv2.bitwise_not(mask.gray[y0:y1, x0:x1]))
+    return background.reshape(-1, 3)[mask.indices]
+
+
+def needs_blend_estimate(parameters) -> bool:
+    return any(params.mode == RemovalMode.ALPHA_UNBLEND for params in parameters)
+
+
+def estimate_watermark_blend(pages, mask: PreparedMask, parameters, max_pages=MAX_MEDIAN_IMAGE_NUMBER):
+    """
+    Estimate the opacity and color of a semi-transparent watermark from the pixels in range
+    of the pages, into ``mask.alpha`` and ``mask.color``.
+    """
+    # Every pixel is a blend I = (1 - alpha) * B + alpha * C of its background and the watermark color,
+    # a line is fitted per pixel over the pages from running sums
+    count = len(mask.indices)
+    n = np.zeros(count, np.float64)
+    sum_b = np.zeros((count, 3), np.float64)
+    sum_i = np.zeros((count, 3), np.float64)
+    sum_bb = np.zeros((count, 3), np.float64)
+    sum_ib = np.zeros((count, 3), np.float64)
+    sum_ii = np.zeros((count, 3), np.float64)
+
+    for img, params in zip(itertools.islice(pages, max_pages), parameters):
+        pixels = img.reshape(-1, 3)[mask.indices]
+        lower = np.array([params.b_min, params.g_min, params.r_min], dtype=np.uint8)
+        upper = np.array([params.b_max, params.g_max, params.r_max], dtype=np.uint8)
+        used = np.all((pixels >= lower) & (pixels <= upper), axis=1)
+        observed = pixels[used].astype(np.float64)
+        background = get_mask_background(img, mask)[used].astype(np.float64)
+        n[used] += 1
+        sum_b[used] += background
+        sum_i[used] += observed
+        sum_bb[used] += background * background
+        sum_ib[used] += observed * background
+        sum_ii[used] += observed * observed
+
+    seen = n > 0
+    safe_n = np.maximum(n, 1)[:, None]
+    mean_b, mean_i = sum_b / safe_n, sum_i / safe_n
+    # One slope (1 - alpha) for the three channels, one intercept (alpha * C) per channel
+    variance = (sum_bb / safe_n - mean_b ** 2).sum(axis=1)
+    covariance = (sum_ib / safe_n - mean_i * mean_b).sum(axis=1)
+    variance_i = (sum_ii / safe_n - mean_i ** 2).sum(axis=1)
+    fitted_alpha = 1 - covariance / np.maximum(variance, 1e-6)
+    # A line is only trusted if the background changes enough and the pixel follows it
+    correlation = covariance / np.sqrt(np.maximum(variance * variance_i, 1e-6))
+    fitted = (n >= 3) & (variance >= MIN_BLEND_VARIANCE) & (correlation >= MIN_BLEND_CORRELATION) & \
+             (fitted_alpha > 0.05) & (fitted_alpha <= MAX_BLEND_ALPHA)
+
+    alpha = np.where(fitted, fitted_alpha, 0)
+    color = np.zeros((count, 3), np.float64)
+    color[fitted] = (mean_i[fitted] - (1 - alpha[fitted, None]) * mean_b[fitted]) / alpha[fitted, None]
+
+    if fitted.any():
+        fallback_color = np.median(color[fitted], axis=0)
+    elif seen.any():
+        # Without a changing background only the direction of the color is known: take it from the
+        # pixel that differs most from the background on (almost) every page, with an assumed opacity
+        steady = np.flatnonzero(n >= 0.9 * n.max())
+        distance = np.abs(mean_i[steady] - mean_b[steady]).sum(axis=1)
+        strongest = steady[np.argmax(distance)]
+        fallback_color = np.clip(mean_b[strongest] + (mean_i[strongest] - mean_b[strongest]) / ASSUMED_BLEND_ALPHA,
+                                 0, 255)
+    else:
+        fallback_color = np.zeros(3)
+
+    # Least squares alpha of I - B = alpha * (C - B) for the given color, from the same sums
+    rest = seen & ~fitted
+    c = fallback_color[None, :]
+    numerator = (c * (sum_i - sum_b) - (sum_ib - sum_bb))[rest].sum(axis=1)
+    denominator = (n[rest, None] * c ** 2 - 2 * c * sum_b[rest] + sum_bb[rest]).sum(axis=1)
+    alpha[rest] = numerator / np.maximum(denominator, 1e-6)
+    color[~fitted] = fallback_color
+
+    # The opacity is smooth inside the watermark, a small median removes pixels spoiled by content in range
+    alpha_image = np.zeros(mask.gray.shape, np.uint8)
+    alpha_image.reshape(-1)[mask.indices] = np.clip(alpha * 255 + 0.5, 0, 255)
+    alpha = cv2.medianBlur(alpha_image, 3).reshape(-1)[mask.indices] / 255.0
+    mask.alpha = np.clip(alpha, 0, MAX_BLEND_ALPHA).astype(np.float32)
+    mask.color = np.clip(color, 0, 255).astype(np.float32)
+    return mask
+
+
+def unblend_image(img, mask: PreparedMask):
+    """Remove the estimated watermark blend from all pixels of the mask: B = (I - alpha * C) / (1 - alpha)."""
+    if mask.alpha is None:
+        raise ValueError("The watermark blend is not estimated, see estimate_watermark_blend.")
+    image = img.copy()
+    pixels = img.reshape(-1, 3)[mask.indices].astype(np.float32)
+    alpha = mask.alpha[:, None]
+    restored = (pixels - alpha * mask.color) / (1 - alpha)
+    image.reshape(-1, 3)[mask.indices] = np.clip(restored + 0.5, 0, 255).astype(np.uint8)
+    return image
 
-        # Show the image with progress bar
-        cv2.imshow('Removing watermark...', image_with_progress)
-        cv2.waitKey(1)
 
-        lower = np.array([parameters[i].b_min, parameters[i].g_min, parameters[i].r_min], dtype=np.uint8)
-        upper = np.array([parameters[i].b_max, parameters[i].g_max, parameters[i].r_max], dtype=np.uint8)
+def get_smooth_background(gray):
+    """Large scale background of a gray image, a median filter wide enough that text and watermark strokes vanish."""
+    ksize = max(3, min(gray.shape[:2]) // 16 | 1)
+    return cv2.medianBlur(gray, ksize)
+
+
+def propose_watermark_mask(pages, max_pages=MAX_MEDIAN_IMAGE_NUMBER, min_contrast=AUTO_MASK_MIN_CONTRAST,
+                           min_fraction=AUTO_MASK_MIN_FRACTION, min_area=AUTO_MASK_MIN_AREA):
+    """
+    Propose a mask of the pixels that differ from their page background on most pages,
+    in one streaming pass.
+    """
+    count = 0
+    for img in itertools.islice(pages, max_pages):
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+        difference = gray.astype(np.int16) - get_smooth_background(gray)
+        if count == 0:
+            sum_difference = np.zeros(gray.shape, np.int32)
+            darker = np.zeros(gray.shape, np.uint16)
+            lighter = np.zeros(gray.shape, np.uint16)
+        sum_difference += difference
+        darker += difference <= -min_contrast
+        lighter += difference >= min_contrast
+        count += 1
+    if count == 0:
+        raise ValueError("No pages to propose a mask from.")
+
+    consistent = np.maximum(darker, lighter) >= min_fraction * count
+    mask = np.where(consistent & (np.abs(sum_difference) >= min_contrast * count), 255, 0).astype(np.uint8)
+
+    # Drop the specks, then cover the anti-aliased edges of the watermark
+    regions, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    small_regions = np.flatnonzero(stats[:, cv2.CC_STAT_AREA] < min_area)
+    mask[np.isin(labels, small_regions[small_regions > 0])] = 0
+    return cv2.dilate(mask, np.ones((5, 5), np.uint8))
+
+
+def get_color_histograms(img, mask: PreparedMask) -> np.ndarray:
+    """Per-channel histograms of the pixels of the mask and of its vicinity, shape (2, 3, 256)."""
+    flat = img.reshape(-1, 3)
+    histograms = np.empty((2, 3, 256), np.int64)
+    for row, indices in enumerate((mask.indices, mask.vicinity)):
+        # The three channels are counted at once, shifted into their own 256 bins
+        values = flat[indices].astype(np.intp) + np.array([0, 256, 512])
+        histograms[row] = np.bincount(values.ravel(), minlength=3 * 256).reshape(3, 256)
+    return histograms
+
+
+def tune_color_ranges(histograms: np.ndarray):
+    """
+    Color range of every page and channel from the stacked histograms of get_color_histograms.
+    Returns the lower and upper bounds (pages, 3) in BGR order and whether a range was found.
+    """
+    counts = np.maximum(histograms.sum(axis=-1, keepdims=True), 1)
+    excess = histograms[:, 0] / counts[:, 0] - histograms[:, 1] / counts[:, 1]
+    # Every value costs a little, so the faint tails (e.g. content under the watermark) are left out
+    score = excess - AUTO_TUNE_MIN_EXCESS * excess.max(axis=-1, keepdims=True)
+
+    cumulative = np.concatenate([np.zeros(score.shape[:-1] + (1,)), np.cumsum(score, axis=-1)], axis=-1)
+    gain = cumulative - np.minimum.accumulate(cumulative, axis=-1)
+    end = gain.argmax(axis=-1)
+    # The interval starts after the lowest cumulative sum before its end
+    before_end = np.where(np.arange(cumulative.shape[-1]) <= end[..., None], cumulative, np.inf)
+    start = before_end.argmin(axis=-1)
+    found = np.all(gain.max(axis=-1) > 0, axis=-1)
+    return start, np.maximum(end - 1, start), found
+
+
+def get_fill_color(img, mask: PreparedMask, options: RemovalOptions):
+    return get_most_frequent_color(img, mask.vicinity if options.fill_from_vicinity else None)
+
+
+def fill_watermark(img, mask: PreparedMask, parameters, options: RemovalOptions = None, fill_color=None):
+    """Replace the watermark pixels of one page according to the removal mode, without sharpening."""
+    options = options or RemovalOptions()
+    lower = np.array([parameters.b_min, parameters.g_min, parameters.r_min], dtype=np.uint8)
+    upper = np.array([parameters.b_max, parameters.g_max, parameters.r_max], dtype=np.uint8)
+
+    if parameters.mode == RemovalMode.ALPHA_UNBLEND:
+        # The content under the watermark is restored too, so every pixel of the mask is un-blended
+        return unblend_image(img, mask)
+
+    image = img.copy()
+    if parameters.mode == RemovalMode.MOST_COMMON_COLOR:
+        if len(mask.indices):
+            # Only the pixels of the mask are looked at, no crops are needed
+            pixels = img.reshape(-1, 3)[mask.indices]
+            in_range = np.all((pixels >= lower) & (pixels <= upper), axis=1)
+            if fill_color is None:
+                fill_color = get_fill_color(img, mask, options)
+            image.reshape(-1, 3)[mask.indices[in_range]] = fill_color
+    else:
+        regions = mask.regions
+        if parameters.mode != RemovalMode.LOCAL_BACKGROUND:
+            # The inpainting at a lower pyramid level reads that many more pixels around the mask
+            regions = mask.get_regions(INPAINT_METHODS[parameters.inpaint_method][1] << parameters.levels)
+        for x0, y0, x1, y1 in regions:
+            crop = img[y0:y1, x0:x1]
+            crop_mask = mask.gray[y0:y1, x0:x1]
+            gray_mask = cv2.inRange(crop, lower, upper)
+            cv2.bitwise_and(gray_mask, crop_mask, gray_mask)
+            if parameters.mode == RemovalMode.LOCAL_BACKGROUND:
+                # Every pixel of the mask may be part of the watermark, only the rest is background
+                background = estimate_background(crop, cv2.bitwise_not(crop_mask))
+                processed_crop = crop.copy()
+                processed_crop[gray_mask > 0] = background[gray_mask > 0]
+                image[y0:y1, x0:x1] = processed_crop
+            else:
+                image[y0:y1, x0:x1] = inpaint_image(crop, gray_mask, parameters.inpaint_method,
+                                                    parameters.levels)
+    return image
 
-        masked_image_part = cv2.bitwise_and(img, mask)
-        gray_mask = cv2.inRange(masked_image_part, lower, upper)
-        gray_mask = cv2.bitwise_and(gray_mask, cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY))
 
-        if parameters[i].mode:
-            image = fill_masked_area(img, gray_mask)
-        else:
-            image = inpaint_image(img, gray_mask)
-        image = sharpen_image(image, parameters[i].w / 10)
+def sharpen_filled_image(image, mask: PreparedMask, w, options: RemovalOptions = None):
+    """Sharpen the page after fill_watermark, the whole page or only the crops around the mask."""
+    options = options or RemovalOptions()
+    w = w / 10
+    if not options.sharpen_mask_only:
+        return sharpen_image(image, w)
+    if w:
+        sharpened = image.copy()
+        for x0, y0, x1, y1 in mask.regions:
+            sharpened[y0:y1, x0:x1] = sharpen_image(image[y0:y1, x0:x1], w)
+        image = sharpened
+    return image
 
-        processed_images.append(image)
 
-    cv2.destroyWindow('Removing watermark...')
-    return processed_images
+def remove_watermark_from_image(img, mask: PreparedMask, parameters, options: RemovalOptions = None, fill_color=None):
+    """Remove the watermark from one page: fill_watermark, then sharpen_filled_image."""
+    image = fill_watermark(img, mask, parameters, options, fill_color)
+    return sharpen_filled_image(image, mask, parameters.w, options)
 
 
-def read_pdf(pdf_path, dpi=300):
-        try:
-            doc = fitz.open(pdf_path)
-            images = []
-            total_pages = len(doc)
+def remove_watermark_cached(img, mask: PreparedMask, parameters, options: RemovalOptions = None,
+                            cache: ProcessedPageCache = None):
+    """remove_watermark_from_image, the result is taken from (or stored in) the cache if one is given."""
+    if cache is None:
+        return remove_watermark_from_image(img, mask, parameters, options)
+    key = cache.get_key(img, mask, parameters, options)
+    image = cache.get(key)
+    if image is None:
+        image = remove_watermark_from_image(img, mask, parameters, options)
+        cache.put(key, image)
+    return image
 
-            print(f"Loading PDF: {os.path.basename(pdf_path)}")
 
-            for page_num in range(total_pages):
-                # Display progress in a progress bar style
-                progress = (page_num + 1) / total_pages
-                print(f"\rLoading page {page_num + 1}/{total_pages} ({(progress * 100):.2f}%)", end='', flush=True)
+# The prepared mask, the options, the cache and the page slots are sent to every worker process once,
+# when the pool starts
+_worker_mask = None
+_worker_options = None
+_worker_cache = None
+_worker_inputs = None
+_worker_outputs = None
+
+def _init_removal_worker(mask, options, cache=None, inputs=None, outputs=None):
+    global _worker_mask, _worker_options, _worker_cache, _worker_inputs, _worker_outputs
+    # The pages are already processed in parallel, OpenCV's own threads would only compete for the cores
+    cv2.setNumThreads(1)
+    _worker_mask = mask
+    _worker_options = options
+    _worker_cache = cache
+    _worker_inputs = inputs
+    _worker_outputs = outputs
+
+def _remove_watermark_worker(slot, parameters):
+    # The page is read from and written back to shared memory, only the slot number is returned
+    image = remove_watermark_cached(_worker_inputs[slot], _worker_mask, parameters, _worker_options, _worker_cache)
+    _worker_outputs[slot] = image
+    return slot, not np.array_equal(image, _worker_inputs[slot])
+
+
+def _check_page_shape(index, img, shape):
+    # The mask and the shared-memory slots are made for the shape of the first page
+    if img.shape != shape:
+        raise ValueError(f"Page {index + 1} has the shape {img.shape}, the watermark can only be removed from "
+                         f"pages of the same shape as the first page {shape}.")
+
+
+def iter_removed_pages(pages, mask, parameters, progress_callback=None, workers=1, total=None,
+                       options: RemovalOptions = None, cache: ProcessedPageCache = None, changed: list = None):
+    """
+    Remove the watermark from any iterable of pages of the same shape and yield them in page order.
+    If ``changed`` is a list, whether each page was changed is appended to it before the page is yielded.
+    """
+    if total is None:
+        total = len(pages)
+    pages = iter(pages)
+    first_page = next(pages, None)
+    if first_page is None:
+        return
+    # Everything derived from the mask is the same for every page
+    if not isinstance(mask, PreparedMask):
+        mask = prepare_mask(mask, first_page.shape)
+    if needs_blend_estimate(parameters) and mask.alpha is None:
+        raise ValueError("The alpha unblend mode needs a mask with an estimated blend, see estimate_watermark_blend.")
+    pages = itertools.chain([first_page], pages)
+
+    workers = max(1, min(workers, total))
+    if workers == 1:
+        for i, img in enumerate(pages):
+            _check_page_shape(i, img, first_page.shape)
+            image = remove_watermark_cached(img, mask, parameters[i], options, cache)
+            if changed is not None:
+                changed.append(not np.array_equal(image, img))
+            yield image
+            if progress_callback is not None:
+                progress_callback(i + 1, total)
+        return
+
+    # Keep a small window of pages in flight, so the memory does not grow with the document length.
+    # Every page in flight has a slot in shared memory, the worker reads the page from its slot and
+    # writes the result back, so only the slot number and the parameters are pickled.
+    max_pending = 2 * workers
+    with PageStack(max_pending, first_page.shape, shared=True) as inputs, \
+            PageStack(max_pending, first_page.shape, shared=True) as outputs, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_removal_worker,
+                                initargs=(mask, options, cache, inputs, outputs)) as executor:
+        pending = deque()
+        free_slots = deque(range(max_pending))
+
+        def next_result():
+            slot, page_changed = pending.popleft().result()
+            if changed is not None:
+                changed.append(page_changed)
+            # The slot is used for the next page, the result has to be copied out
+            image = outputs.array[slot].copy()
+            free_slots.append(slot)
+            return image
+
+        done = 0
+        for i, img in enumerate(pages):
+            _check_page_shape(i, img, first_page.shape)
+            slot = free_slots.popleft()
+            inputs[slot] = img
+            pending.append(executor.submit(_remove_watermark_worker, slot, parameters[i]))
+            while len(pending) >= max_pending:
+                done += 1
+                yield next_result()
+                if progress_callback is not None:
+                    progress_callback(done, total)
+        while pending:
+            done += 1
+            yield next_result()
+            if progress_callback is not None:
+                progress_callback(done, total)
+
+
+def remove_watermark(images, mask, parameters, progress_callback=None, workers=1, options: RemovalOptions = None,
+                     cache: ProcessedPageCache = None, changed: list = None):
+    total_images = len(images)
+    # The mask is shaped like the pages that are processed, the first iterated one
+    pages = iter(images)
+    first_page = next(pages)
+    mask = prepare_mask(mask, first_page.shape)
+    if needs_blend_estimate(parameters):
+        estimate_watermark_blend(images, mask, parameters)
+    # The pages can be rendered on demand (PdfPages), so they are streamed through the workers
+    # instead of being submitted all at once, and gathered in one contiguous stack
+    return stack_pages(iter_removed_pages(itertools.chain([first_page], pages), mask, parameters, progress_callback,
+                                          workers, total_images, options, cache, changed), total_images)
+
+
+# MuPDF must not be used from several threads at once, every use of fitz in this process holds
+# this lock (the preview pages are rendered in background threads). Forking waits for it as well,
+# so that no thread is inside MuPDF when a worker process is created (Windows spawns them instead).
+mupdf_lock = threading.RLock()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=mupdf_lock.acquire, after_in_parent=mupdf_lock.release,
+                        after_in_child=mupdf_lock.release)
+
+
+def get_page_count(pdf_path):
+    with mupdf_lock, fitz.open(pdf_path) as doc:
+        return len(doc)
+
+
+class _PixmapBuffer:
+    """Exposes the samples of a pixmap to NumPy and keeps the pixmap alive as long as the array exists."""
+    def __init__(self, pix):
+        self.pix = pix
+        self.__array_interface__ = {
+            'shape': (pix.height, pix.width, pix.n),
+            'strides': (pix.stride, pix.n, 1),
+            'typestr': '|u1',
+            'data': (pix.samples_ptr, False),
+            'version': 3,
+        }
+
+
+def pixmap_to_bgr(pix):
+    """Return the pixmap as a BGR image without copying, the RGB -> BGR swap is done in the pixmap's own buffer."""
+    image = np.asarray(_PixmapBuffer(pix))
+    if pix.n == 3:
+        cv2.cvtColor(image, cv2.COLOR_RGB2BGR, image)
+    elif pix.n == 1:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    else:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2BGR)
+    return image
 
-                page = doc.load_page(page_num)
-                pix = page.get_pixmap(dpi=dpi)
-                img_bytes = pix.tobytes('png')
-                img_array = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-                cv2.cvtColor(img_array, cv2.COLOR_BGR2RGB, img_array)
-                images.append(img_array)
 
-            print("\nPDF loading complete.")
+def get_scanned_page_image(page, size=None):
+    """
+    Xref of the embedded image of the page if it only shows one upright full-page image (of
+    ``size``, if given), otherwise None.
+    """
+    images = page.get_images(full=True)
+    if len(images) != 1 or page.rotation:
+        return None
+    xref, smask, width, height = images[0][:4]
+    if smask or (size is not None and (width, height) != size):
+        return None
+    # get_image_rects would be much slower, it computes a hash of the image to find it
+    infos = page.get_image_info()
+    if len(infos) != 1:
+        return None
+    a, b, c, d = infos[0]['transform'][:4]
+    bbox = fitz.Rect(infos[0]['bbox'])
+    if b or c or a <= 0 or d <= 0 or \
+            max(abs(bbox.x0 - page.rect.x0), abs(bbox.y0 - page.rect.y0),
+                abs(bbox.x1 - page.rect.x1), abs(bbox.y1 - page.rect.y1)) > 1:
+        return None
+    # Anything else the page draws, apart from invisible (OCR) text, clipping and the annotations,
+    # would be lost with the image
+    annot_rects = [annot.rect for annot in page.annots()]
+    for kind, bbox in page.get_bboxlog():
+        if kind in ('fill-image', 'ignore-text') or kind.startswith(('clip-', 'pop-', 'begin-', 'end-')):
+            continue
+        if not any(fitz.Rect(bbox) in rect for rect in annot_rects):
+            return None
+    return xref
+
+
+def get_scanned_page_images(doc):
+    """Xref of the image of every page if all are scanned pages of the same size, otherwise None."""
+    xrefs = []
+    size = None
+    for page in doc:
+        xref = get_scanned_page_image(page, size)
+        if xref is None:
+            return None
+        if size is None:
+            size = tuple(page.get_images(full=True)[0][2:4])
+        xrefs.append(xref)
+    return xrefs or None
+
+
+def extract_page_image(doc, xref):
+    """Decode an embedded image at its native resolution as a BGR image."""
+    pix = fitz.Pixmap(doc, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.colorspace is not None and pix.colorspace.n not in (1, 3):
+        pix = fitz.Pixmap(fitz.csRGB, pix)
+    return pixmap_to_bgr(pix)
+
+
+def render_page(doc, page_num, dpi, xref=None):
+    """The page as a BGR image, its embedded image ``xref`` if given or rendered at ``dpi`` (can be fractional)."""
+    if xref is not None:
+        return extract_page_image(doc, xref)
+    return pixmap_to_bgr(doc.load_page(page_num).get_pixmap(matrix=fitz.Matrix(dpi / 72, dpi / 72)))
+
+
+def iter_pdf_pages(pdf_path, dpi=300, progress_callback=None, cache: RasterCache = None, workers=1,
+                   extract_images=True):
+    """
+    Yield the pages of the PDF as BGR images, rendered by ``workers`` processes, or the embedded
+    images of a scan if ``extract_images`` is set.
+    """
+    with mupdf_lock, fitz.open(pdf_path) as doc:
+        xrefs = get_scanned_page_images(doc) if extract_images else None
+    # The native resolution is cached as DPI 0
+    yield from iter_pdf_page_images(pdf_path, xrefs, dpi, 0 if xrefs is not None else dpi, progress_callback,
+                                    cache, workers)
+
+
+def iter_pdf_page_images(pdf_path, xrefs, dpi, cache_dpi, progress_callback=None, cache: RasterCache = None,
+                         workers=1):
+    """
+    Yield the pages of the PDF, the embedded image of the pages with an xref in ``xrefs`` (None for
+    all pages rendered) and the others rendered at ``dpi``. They are cached as ``cache_dpi``.
+    """
+    with mupdf_lock, fitz.open(pdf_path) as doc:
+        total_pages = len(doc)
+    if workers > 1 and total_pages > 1:
+        yield from _iter_pdf_pages_parallel(pdf_path, dpi, cache_dpi, progress_callback, cache, workers, xrefs)
+        return
+    document_key = cache.get_document_key(pdf_path) if cache is not None else None
+    with mupdf_lock:
+        doc = fitz.open(pdf_path)
+    try:
+        for page_num in range(total_pages):
+            image = cache.get(document_key, page_num, cache_dpi) if cache is not None else None
+            if image is None:
+                # The lock is not held while the page is used, the consumer may need MuPDF too
+                with mupdf_lock:
+                    image = render_page(doc, page_num, dpi, xrefs[page_num] if xrefs is not None else None)
+                if cache is not None:
+                    image = cache.put(document_key, page_num, cache_dpi, image)
+            yield image
+            if progress_callback is not None:
+                progress_callback(page_num + 1, total_pages)
+    finally:
+        with mupdf_lock:
+            doc.close()
+
+
+# Every rendering process opens the document once, when the pool starts
+_render_doc = None
+_render_slots = None
+_render_xrefs = None
+
+def _init_render_worker(pdf_path, slots, xrefs=None):
+    global _render_doc, _render_slots, _render_xrefs
+    _render_doc = fitz.open(pdf_path)
+    _render_slots = slots
+    _render_xrefs = xrefs
+
+def _render_page_worker(page_num, dpi, slot):
+    image = render_page(_render_doc, page_num, dpi, _render_xrefs[page_num] if _render_xrefs is not None else None)
+    height, width = image.shape[:2]
+    slot_height, slot_width = _render_slots.page_shape[:2]
+    if height > slot_height or width > slot_width:
+        return image.shape, image
+    # The page is returned through shared memory, only its shape is pickled
+    _render_slots[slot][:height, :width] = image
+    return image.shape, None
+
+
+def _get_page_size(page, dpi, xref=None):
+    if xref is not None:
+        width, height = page.get_images(full=True)[0][2:4]
+        return height, width
+    rect = (page.rect * fitz.Matrix(dpi / 72, dpi / 72)).irect
+    return rect.height, rect.width
+
+
+def _iter_pdf_pages_parallel(pdf_path, dpi, cache_dpi, progress_callback, cache, workers, xrefs=None):
+    document_key = cache.get_document_key(pdf_path) if cache is not None else None
+    with mupdf_lock, fitz.open(pdf_path) as doc:
+        sizes = [_get_page_size(page, dpi, xrefs[page.number] if xrefs is not None else None) for page in doc]
+    total_pages = len(sizes)
+    workers = min(workers, total_pages)
+    # One slot of the largest page size for every page in flight
+    max_pending = 2 * workers
+    slot_shape = (max(size[0] for size in sizes), max(size[1] for size in sizes), 3)
+    with PageStack(max_pending, slot_shape, shared=True) as slots, \
+            ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker,
+                                initargs=(pdf_path, slots, xrefs)) as executor:
+        pending = deque()
+        free_slots = deque(range(max_pending))
+
+        def next_page():
+            page_num, slot, result = pending.popleft()
+            if slot is None:
+                # Memory-mapped from the cache
+                return result
+            shape, image = result.result()
+            if image is None:
+                image = slots.array[slot][:shape[0], :shape[1]].copy()
+            free_slots.append(slot)
+            if cache is not None:
+                image = cache.put(document_key, page_num, cache_dpi, image)
+            return image
+
+        done = 0
+        for page_num in range(total_pages):
+            image = cache.get(document_key, page_num, cache_dpi) if cache is not None else None
+            if image is not None:
+                pending.append((page_num, None, image))
+            else:
+                slot = free_slots.popleft()
+                pending.append((page_num, slot, executor.submit(_render_page_worker, page_num, dpi, slot)))
+            while len(pending) >= max_pending:
+                done += 1
+                yield next_page()
+                if progress_callback is not None:
+                    progress_callback(done, total_pages)
+        while pending:
+            done += 1
+            yield next_page()
+            if progress_callback is not None:
+                progress_callback(done, total_pages)
+
+
+def read_pdf(pdf_path, dpi=300, cache: RasterCache = None, workers=1, extract_images=True):
+        try:
+            print(f"Loading PDF: {os.path.basename(pdf_path)}")
+            images = list(iter_pdf_pages(pdf_path, dpi, partial(print_progress, text='Loading PDF'), cache, workers,
+                                         extract_images))
+            print("PDF loading complete.")
             return images
         except Exception as e:
             text = f"Error reading PDF: {e}"
             print(text)
-            # Return a blank image in case of error, with values of 255
-            blank_image = np.ones((1000, 700, 3), np.uint8) * 100
-            # cv2.putText(blank_image, text, (15, 39), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
-            return [blank_image]
+            # Return a blank image in case of error
+            return [get_blank_image()]
 
-def resize_images(images, max_width=None, max_height=None):
-    img_width, img_height = images[0].shape[:2]
+def get_blank_image():
+    blank_image = np.ones((1000, 700, 3), np.uint8) * 100
+    # cv2.putText(blank_image, text, (15, 39), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 2)
+    return blank_image
+
+def get_resized_shape(shape, max_width=None, max_height=None):
+    """Shape of the images of ``shape`` after resize_images."""
+    img_width, img_height = shape[:2]
     width_ratio = max_width / float(img_width)
     height_ratio = max_height / float(img_height)
     ratio = min(width_ratio, height_ratio)
     new_width = int(img_width * ratio)
     new_height = int(img_height * ratio)
+    return (new_width, new_height) + tuple(shape[2:])
+
+def resize_images(images, max_width=None, max_height=None):
+    new_width, new_height = get_resized_shape(images[0].shape, max_width, max_height)[:2]
     return [cv2.resize(img, (new_height, new_width), interpolation=cv2.INTER_AREA) for img in images]
 
+def read_mask(path):
+    mask = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if mask is None:
+        raise ValueError(f"Could not read mask from {path}")
+    if len(mask.shape) == 3 and mask.shape[2] == 4:
+        mask = cv2.cvtColor(mask, cv2.COLOR_BGRA2GRAY)
+    elif len(mask.shape) == 3 and mask.shape[2] == 3:
+        mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
+    return mask
+
 def resize_mask(mask, height, width):
     return cv2.resize(mask, (height, width), interpolation=cv2.INTER_AREA)
 
-def load_pdf(pdf_path, dpi=200):
-    images = read_pdf(pdf_path, dpi)
-    images = convert_images(images)
-    return images
-
-def save_images(images, path: str = 'output') -> int:
-
-    images = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB) for image in images]
-    height, width = images[0].shape[:2]
-    doc = fitz.open()
-    rect = fitz.Rect(0, 0, width, height)
-    for image in images:
-        temp_img_path = 'temp_image.jpg'
-        # Save as JPEG with quality 80
-        cv2.imwrite(temp_img_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR), [int(cv2.IMWRITE_JPEG_QUALITY), 80])
-        page = doc.new_page(width=width, height=height)
-        page.insert_image(rect, filename=temp_img_path)
+def load_pdf(pdf_path, dpi=200, cache: RasterCache = None, workers=1, extract_images=True):
+    return read_pdf(pdf_path, dpi, cache, workers, extract_images)
+
+def encode_jpeg(image, quality=80):
+    success, buffer = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    if not success:
+        raise ValueError("Could not encode image as JPEG.")
+    return buffer.tobytes()
+
+def _insert_jpeg_page(doc, shape, jpeg_bytes):
+    height, width = shape[:2]
+    page = doc.new_page(width=width, height=height)
+    page.insert_image(fitz.Rect(0, 0, width, height), stream=jpeg_bytes)
+
+def save_images(images, path: str = 'output', workers=None) -> int:
+    """Write the BGR images (any iterable) as the pages of a new PDF."""
+    workers = workers or os.cpu_count() or 1
+    with mupdf_lock:
+        doc = fitz.open()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for image in images:
+            pending.append((image.shape, executor.submit(encode_jpeg, image)))
+            while len(pending) >= 2 * workers:
+                shape, future = pending.popleft()
+                with mupdf_lock:
+                    _insert_jpeg_page(doc, shape, future.result())
+        while pending:
+            shape, future = pending.popleft()
+            with mupdf_lock:
+                _insert_jpeg_page(doc, shape, future.result())
 
     file_path = f'{path}.pdf'
-    doc.save(file_path, deflate=True, garbage=4)
-    doc.close()
-    os.remove(temp_img_path)
+    with mupdf_lock:
+        doc.save(file_path, deflate=True, garbage=4)
+        doc.close()
+    return _report_saved_file(file_path)
 
+
+def _report_saved_file(file_path) -> int:
     # Get actual file size
     actual_size_bytes = os.path.getsize(file_path)
 
@@ -187,3 +927,70 @@ def save_images(images, path: str = 'output') -> int:
     print(f"Images saved as {file_path} (Size: {actual_size_str})")
     return actual_size_bytes
 
+
+def _encode_page(image, gray):
+    if gray:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image.shape[:2], encode_jpeg(image)
+
+
+def _replace_image_stream(doc, xref, shape, jpeg_bytes, gray):
+    """Replace the data of the image object in place, every page that shows it shows the new image."""
+    height, width = shape
+    doc.update_stream(xref, jpeg_bytes, compress=False)
+    # Keys of the old image that do not apply to the JPEG are removed (set to null)
+    for key, value in (('Filter', '/DCTDecode'), ('Width', str(width)), ('Height', str(height)),
+                       ('ColorSpace', '/DeviceGray' if gray else '/DeviceRGB'), ('BitsPerComponent', '8'),
+                       ('DecodeParms', 'null'), ('Decode', 'null'), ('Mask', 'null')):
+        doc.xref_set_key(xref, key, value)
+
+
+def save_images_in_place(images, pdf_path, path: str = 'output', workers=None, changed=None) -> int:
+    """
+    Replace the images of the ``changed`` pages (all if None) in a copy of the scanned PDF, only
+    those pages are read if ``images`` can be indexed. Other documents are saved with save_images.
+    """
+    with mupdf_lock:
+        doc = fitz.open(pdf_path)
+        xrefs = get_scanned_page_images(doc)
+    try:
+        if xrefs is None or len(set(xrefs)) != len(xrefs):
+            return save_images(images, path, workers)
+
+        workers = workers or os.cpu_count() or 1
+
+        def replace_page_image(page_num, gray, future):
+            with mupdf_lock:
+                _replace_image_stream(doc, xrefs[page_num], *future.result(), gray)
+
+        if changed is not None and hasattr(images, '__getitem__'):
+            # Only the changed pages are read, the others are not even rendered (PdfPages)
+            page_images = ((page_num, images[page_num]) for page_num, page_changed in enumerate(changed)
+                           if page_changed)
+        else:
+            # A stream of pages, e.g. from iter_removed_pages that fills ``changed`` as it goes
+            page_images = ((page_num, image) for page_num, image in enumerate(images)
+                           if changed is None or changed[page_num])
+        replaced = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for page_num, image in page_images:
+                with mupdf_lock:
+                    gray = doc.load_page(page_num).get_image_info()[0]['colorspace'] == 1
+                pending.append((page_num, gray, executor.submit(_encode_page, image, gray)))
+                replaced += 1
+                while len(pending) >= 2 * workers:
+                    replace_page_image(*pending.popleft())
+            while pending:
+                replace_page_image(*pending.popleft())
+
+        print(f"Replaced the images of {replaced} of {len(xrefs)} pages")
+        file_path = f'{path}.pdf'
+        # Only the replaced images are dropped, the other objects are written as they are
+        with mupdf_lock:
+            doc.save(file_path, garbage=1)
+    finally:
+        with mupdf_lock:
+            doc.close()
+    return _report_saved_file(file_path)
+
@@ -150,6 +150,10 @@ class SidebarBuilder:
                 slider.valueChanged.connect(lambda val, cb=value['callback']: cb(float(val)))
             else:
                 slider.valueChanged.connect(lambda val, cb=value['callback']: cb(val))
+            if 'press_callback' in value:
+                slider.sliderPressed.connect(value['press_callback'])
+            if 'release_callback' in value:
+                slider.sliderReleased.connect(value['release_callback'])
 
             slider_layout.addWidget(slider)
             self.sidebar.layout().addLayout(slider_layout)
@@ -85,6 +85,10 @@ class TkinterView(DisplayInterface):
             scale = tk.Scale(self.sidebar, from_=range_min, to=range_max, orient='horizontal',
                              label=name, command=value['callback'], length=200)
             scale.set(value['value'])
+            if 'press_callback' in value:
+                scale.bind('<ButtonPress-1>', lambda event, cb=value['press_callback']: cb())
+            if 'release_callback' in value:
+                scale.bind('<ButtonRelease-1>', lambda event, cb=value['release_callback']: cb())
             scale.pack()
 
     def _create_buttons(self, buttons):
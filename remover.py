@@ -1,6 +1,5 @@
 import argparse
-
-from modules.controller.base_controller import BaseController
+import os
 
 import sys
 sys.setrecursionlimit(2000)  # Example: increase limit
@@ -19,20 +18,46 @@ DEFAULT_GUI = 'tkinter'
 # Set the DPI for the images, this affects the quality of the final PDF
 DPI = 175
 
+# Memory budget (in MB) of the cached median images
+MEDIAN_CACHE_MB = 256
+
+# Number of processes used for rendering the pages and for the watermark removal
+WORKERS = os.cpu_count() or 1
+
+# Directory of the rendered and processed pages kept between runs, None disables the cache
+CACHE_DIR = None
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Remove watermark from PDF.')
     parser.add_argument('--pdf_path', type=str, nargs='?', default=PDF_PATH, help='Path to the input PDF file.')
     parser.add_argument('--gui_type', type=str, nargs='?', default=DEFAULT_GUI, help='Type of GUI to use. Default is tkinter.')
-    parser.add_argument('--dpi', type=int, default=DPI, help='DPI for the images. Default is 300.')
+    parser.add_argument('--dpi', type=int, default=DPI, help=f'DPI for the images. Default is {DPI}. Scanned PDFs are loaded at the native resolution of their images instead.')
     parser.add_argument('--max_width', type=int, default=MAX_WIDTH, help=f'Maximum width for the images. Default is {MAX_WIDTH}.')
     parser.add_argument('--max_height', type=int, default=MAX_HEIGHT, help=f'Maximum height for the images. Default is {MAX_HEIGHT}.')
+    parser.add_argument('--median_cache_mb', type=int, default=MEDIAN_CACHE_MB, help=f'Memory budget of the cached median images and the pages they are computed from in MB. Default is {MEDIAN_CACHE_MB}.')
+    parser.add_argument('--workers', type=int, default=WORKERS, help=f'Number of processes used for rendering the pages and for the watermark removal. Default is the number of CPUs ({WORKERS}).')
+    parser.add_argument('--cache_dir', type=str, default=CACHE_DIR, help='Directory where the rendered and processed pages are kept, so that a document is not rendered again when it is reopened and unchanged pages are not processed again on the next export (also in a later session). Disabled by default.')
+    parser.add_argument('--sharpen_mask_only', action='store_true', help='Sharpen only the areas around the mask instead of the whole page.')
+    parser.add_argument('--fill_from_vicinity', action='store_true', help='Take the fill color (most_common_color mode) from the vicinity of the mask instead of the whole page.')
+    parser.add_argument('--headless', action='store_true', help='Remove the watermark without opening a window.')
+    parser.add_argument('--mask_path', type=str, default=None, help='Path to a saved mask. In headless mode a mask is proposed from the pages if it is not given.')
+    parser.add_argument('--params_path', type=str, default=None, help='Path to a saved parameter file (JSON).')
+    parser.add_argument('--auto_tune', action='store_true', help='Tune the color ranges of every page automatically in headless mode.')
+    parser.add_argument('--save_path', type=str, default=SAVE_PATH, help=f'Path of the output PDF in headless mode. Default is {SAVE_PATH}.')
     return parser.parse_args()
 
 
 def main():
     args = parse_args()
 
+    # The GUI modules are imported lazily, so headless runs work without a display
+    if args.headless:
+        from modules.controller.headless_controller import HeadlessController
+        HeadlessController(args).run()
+        return
+
+    from modules.controller.base_controller import BaseController
     selector = BaseController(args)
     selector.run()
 